@@ -1,9 +1,21 @@
+import logging
+
 import dash
 import dash_bootstrap_components as dbc
-from dash import dcc, html
+import flask
+from dash import DiskcacheManager, dcc, html
+
+from cache import job_cache
+from resources import compute_resources
+
+# Progress of the t-SNE runs and of the explanations is reported through the insight_sne logger
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
 
+# t-SNE runs are executed as background jobs in worker processes, queued in a local diskcache
+background_callback_manager = DiskcacheManager(job_cache)
 
-app = dash.Dash(__name__, use_pages=True, external_stylesheets=[dbc.themes.BOOTSTRAP])
+app = dash.Dash(__name__, use_pages=True, external_stylesheets=[dbc.themes.BOOTSTRAP],
+                background_callback_manager=background_callback_manager)
 server = app.server
 app.layout = html.Div([
     dcc.Location(id='url', refresh=True),
@@ -12,5 +24,11 @@ app.layout = html.Div([
 ])  
 
 
+@server.route("/resources")
+def resources():
+    """Current split of the compute threads between the running jobs."""
+    return flask.jsonify(compute_resources.allocation())
+
+
 if __name__ == '__main__':
     app.run_server(debug=True)
@@ -0,0 +1,249 @@
+import json
+
+import numpy as np
+import pandas as pd
+from sklearn import datasets, preprocessing
+from sklearn.datasets import make_blobs
+
+import explainer
+import plots
+import tsne
+from quadtree import QuadTree
+
+
+################################
+########### Datasets ###########
+################################
+
+
+def load_dataset(name, n = None, d = None, seed = 0):
+    """Standardized bundled dataset (iris, diabetes, countries, zoo), or Gaussian blobs of n points in d dimensions."""
+
+    if name == "iris":
+        X = datasets.load_iris().data
+    elif name == "diabetes":
+        X = datasets.load_diabetes().data
+    elif name == "countries":
+        X = pd.read_csv("datasets/country_dataset_with_names.csv", index_col = 0).to_numpy().astype(np.float64)
+    elif name == "zoo":
+        zoo = pd.read_csv("datasets/zoo.csv", index_col = 0)
+        del zoo['class_type']
+        X = zoo.to_numpy().astype(np.float64)
+    else:
+        X = make_blobs(n_samples=n, n_features=d, centers=10, random_state=seed)[0]
+    return preprocessing.StandardScaler().fit_transform(X)
+
+
+def _embedding(X, seed = 0):
+    return np.random.RandomState(seed).randn(X.shape[0], 2) * 10
+
+
+def _joint_p(X, perplexity = 30.0):
+    P = tsne._x2p(X, 1e-5, perplexity)[0]
+    P = P + P.T
+    return np.maximum(P / P.sum(), 1e-12)
+
+
+################################
+############ Cases #############
+################################
+
+
+class Case:
+    """A benchmark: setup(**params) prepares the inputs and returns the callable that is measured. The payload of
+    the result of the callable (the size of its JSON, for figures and callback outputs) is recorded too."""
+
+    def __init__(self, name, setup, grid, quick_grid = None):
+        self.name = name
+        self.setup = setup
+        self.grid = grid
+        self.quick_grid = quick_grid if quick_grid is not None else grid[:1]
+
+    def params(self, quick = False):
+        return self.quick_grid if quick else self.grid
+
+
+def _x2p_case(dataset, n = None, d = None, perplexity = 30.0, method = "exact", memory_budget = None):
+    X = load_dataset(dataset, n, d)
+    return lambda: tsne._x2p(X, 1e-5, perplexity, method=method, memory_budget=memory_budget)
+
+
+def _tsne_case(dataset, n = None, d = None, perplexity = 30.0, method = "exact", max_iter = 100, memory_budget = None):
+    X = load_dataset(dataset, n, d)
+    return lambda: tsne.compute_tsne(X, 2, perplexity, max_iter, method=method, seed=0, memory_budget=memory_budget)
+
+
+def _gradients_case(dataset, n = None, d = None, n_jobs = 1):
+    X = load_dataset(dataset, n, d)
+    Y, P, Q, sigma = tsne.compute_tsne(X, 2, 30.0, 50, seed=0)
+    return lambda: explainer.compute_all_gradients(X, Y, P, Q, sigma, n_jobs=n_jobs)
+
+
+def _embedding_plot_case(dataset, n = None, d = None):
+    X = load_dataset(dataset, n, d)
+    Y = _embedding(X)
+    return lambda: plots.create_plot_tsne_embedding(X, Y, np.zeros(X.shape[0], dtype=int), "iris")
+
+
+def _overlay_case(dataset, n = None, d = None):
+    X = load_dataset(dataset, n, d)
+    Y = _embedding(X)
+    gradients = np.random.RandomState(0).randn(X.shape[0], 2)
+
+    def run():
+        grid_x, grid_y, grids = plots.compute_feature_grids(X, Y)
+        return [plots.create_feature_contour_trace(grid_x, grid_y, grids[0]), plots.create_gradient_arrows_trace(Y, gradients)]
+    return run
+
+
+def _bar_plots_case(dataset, n = None, d = None):
+    X = load_dataset(dataset, n, d)
+    features = ["feature %d" % i for i in range(X.shape[1])]
+
+    def run():
+        return [plots.create_feature_importance_ranking_plot(None, features, np.ones(X.shape[1])),
+                plots.create_average_feature_distribution_plot(features, X, np.arange(X.shape[0]))]
+    return run
+
+
+def _run_tsne_case(dataset, perplexity = 30.0, max_iter = 100):
+    # After the first run, the t-SNE comes from the result cache, so this measures the rest of the callback
+    import app # registers the pages
+    from pages.configuration import run_tsne
+    return lambda: run_tsne(dataset, perplexity, max_iter)
+
+
+BLOBS = "blobs"
+
+CASES = [
+    Case("x2p", _x2p_case,
+         [dict(dataset=BLOBS, n=n, d=d, perplexity=p, method=m) for n in (1000, 5000) for d in (10, 100)
+          for p in (10.0, 30.0, 50.0) for m in ("exact", "knn")]
+         + [dict(dataset=BLOBS, n=5000, d=10, perplexity=30.0, method="exact", memory_budget=2**26)],
+         [dict(dataset=BLOBS, n=1000, d=10, perplexity=30.0, method=m) for m in ("exact", "knn")]),
+    Case("compute_tsne", _tsne_case,
+         [dict(dataset=ds, method="exact") for ds in ("iris", "diabetes", "countries", "zoo")]
+         + [dict(dataset=BLOBS, n=n, d=50, method=m) for n in (1000, 3000) for m in ("exact", "barnes_hut")]
+         + [dict(dataset=BLOBS, n=3000, d=50, method="exact", memory_budget=2**26),
+            dict(dataset=BLOBS, n=10000, d=50, method="barnes_hut")],
+         [dict(dataset="iris", method="exact"), dict(dataset=BLOBS, n=1000, d=50, method="barnes_hut")]),
+    Case("compute_all_gradients", _gradients_case,
+         [dict(dataset=ds) for ds in ("iris", "countries", "zoo")]
+         + [dict(dataset=BLOBS, n=1000, d=d) for d in (10, 50)] + [dict(dataset=BLOBS, n=1000, d=10, n_jobs=2)],
+         [dict(dataset="iris")]),
+    Case("create_plot_tsne_embedding", _embedding_plot_case,
+         [dict(dataset="iris")] + [dict(dataset=BLOBS, n=n, d=10) for n in (1000, 10000)]),
+    Case("feature_overlays", _overlay_case,
+         [dict(dataset="countries")] + [dict(dataset=BLOBS, n=n, d=10) for n in (1000, 10000)]),
+    Case("feature_bar_plots", _bar_plots_case,
+         [dict(dataset="countries"), dict(dataset=BLOBS, n=10000, d=100)]),
+    Case("run_tsne", _run_tsne_case,
+         [dict(dataset=ds) for ds in ("iris", "diabetes", "countries", "zoo")]),
+]
+
+
+################################
+####### Equality checks ########
+################################
+
+
+def _reference_gradient(Y, P):
+    """The exact gradient written as in the original loop over the points."""
+
+    n = Y.shape[0]
+    sum_Y = np.sum(np.square(Y), 1)
+    num = -2. * np.dot(Y, Y.T)
+    num = 1. / (1. + np.add(np.add(num, sum_Y).T, sum_Y))
+    num[range(n), range(n)] = 0.
+    Q = np.maximum(num / np.sum(num), 1e-12)
+    PQ = P - Q
+    dY = np.zeros_like(Y)
+    for i in range(n):
+        dY[i, :] = np.sum(np.tile(PQ[:, i] * num[:, i], (Y.shape[1], 1)).T * (Y[i, :] - Y), 0)
+    return dY
+
+
+def _reference_repulsion(Y):
+    """Exact repulsive forces and normalizations that QuadTree.repulsive_forces approximates."""
+
+    diff = Y[:, np.newaxis, :] - Y
+    num = 1 / (1 + np.sum(np.square(diff), 2))
+    np.fill_diagonal(num, 0)
+    return np.einsum('ij,ijk->ik', num**2, diff), np.sum(num, 1)
+
+
+def _relative_error(a, b):
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    return float(np.max(np.abs(a - b)) / max(np.max(np.abs(b)), np.finfo('double').tiny))
+
+
+def check_gradient():
+    X = load_dataset(BLOBS, 500, 10)
+    Y, P = _embedding(X), _joint_p(X)
+    n = X.shape[0]
+    dY = np.empty_like(Y)
+    tsne._exact_gradient(Y, P, np.empty((n, n)), np.empty((n, n)), np.empty((n, n)), dY)
+    return _relative_error(dY, _reference_gradient(Y, P)), 1e-10
+
+
+def check_blocked_gradient():
+    X = load_dataset(BLOBS, 500, 10)
+    Y, P = _embedding(X), _joint_p(X)
+    n = X.shape[0]
+    dY, blocked = np.empty_like(Y), np.empty_like(Y)
+    tsne._exact_gradient(Y, P, np.empty((n, n)), np.empty((n, n)), np.empty((n, n)), dY)
+    tsne._exact_gradient_blocked(Y, P, blocked, 64)
+    return _relative_error(blocked, dY), 1e-8
+
+
+def check_blocked_x2p():
+    X = load_dataset(BLOBS, 500, 10)
+    return _relative_error(tsne._x2p(X, memory_budget=2**20)[0], tsne._x2p(X)[0]), 1e-10
+
+
+def check_knn_x2p():
+    # With all the other points as neighbours, the kNN calibration is the exact one
+    X = load_dataset(BLOBS, 200, 10)
+    return _relative_error(tsne._x2p(X, perplexity=100.0, method="knn")[0].toarray(), tsne._x2p(X, perplexity=100.0)[0]), 1e-8
+
+
+def check_quadtree():
+    X = load_dataset(BLOBS, 500, 10)
+    Y = _embedding(X)
+    neg_f, sum_Q = QuadTree(Y).repulsive_forces(theta=0)
+    ref_f, ref_Q = _reference_repulsion(Y)
+    return max(_relative_error(neg_f, ref_f), _relative_error(sum_Q, ref_Q)), 1e-10
+
+
+def check_batched_explanations():
+    X = load_dataset("iris")
+    Y, P, Q, sigma = tsne.compute_tsne(X, 2, 30.0, 50, seed=0)
+    gradients = explainer.compute_all_gradients(X, Y, P, Q, sigma)
+    context = explainer.ExplainerContext(X, Y, P, Q, sigma)
+    reference = np.array([explainer.compute_gradients(X, Y, P, Q, sigma, i, context) for i in range(0, X.shape[0], 10)])
+    return _relative_error(gradients[::10], reference), 1e-8
+
+
+def check_parallel_explanations():
+    X = load_dataset("iris")
+    Y, P, Q, sigma = tsne.compute_tsne(X, 2, 30.0, 50, seed=0)
+    return _relative_error(explainer.compute_all_gradients(X, Y, P, Q, sigma, n_jobs=2),
+                           explainer.compute_all_gradients(X, Y, P, Q, sigma)), 0.0
+
+
+CHECKS = [check_gradient, check_blocked_gradient, check_blocked_x2p, check_knn_x2p, check_quadtree,
+          check_batched_explanations, check_parallel_explanations]
+QUICK_CHECKS = CHECKS[:-1]
+
+
+def payload_size(result):
+    """Size in bytes of the JSON sent to the browser for a figure, a list of traces or a callback output, else None."""
+
+    if isinstance(result, str):
+        return len(result.encode())
+    if hasattr(result, "to_json"):
+        return len(result.to_json().encode())
+    if isinstance(result, list) and result and all(hasattr(r, "to_plotly_json") for r in result):
+        return sum(len(r.to_json().encode()) if hasattr(r, "to_json") else len(json.dumps(r.to_plotly_json()).encode())
+                   for r in result)
+    return None
@@ -0,0 +1,165 @@
+"""
+Benchmarks of the t-SNE, explainer and plotting hot paths.
+
+Every case is run over its grid of datasets and parameters, recording the wall time (best of --repeat runs),
+the peak memory traced by tracemalloc and, for figures and callback outputs, the size of the JSON payload.
+Results are compared with a stored baseline to flag regressions, and the fast paths are checked against
+their reference implementations.
+
+    python benchmarks/run.py --quick                 # small grid, to check that nothing regressed
+    python benchmarks/run.py --save-baseline         # record the baseline of this machine
+    python benchmarks/run.py --filter compute_tsne   # only the cases whose name contains compute_tsne
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from benchmarks.cases import CASES, CHECKS, QUICK_CHECKS, payload_size
+
+DEFAULT_BASELINE = os.path.join("benchmarks", "baseline.json")
+
+
+def case_key(name, params):
+    return name + "[" + ",".join("%s=%s" % (k, v) for k, v in sorted(params.items())) + "]"
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silences the prints and the insight_sne INFO logs (enabled by importing app) of the block, which would
+    interleave with the results and be timed with them."""
+
+    logger = logging.getLogger("insight_sne")
+    level = logger.level
+    logger.setLevel(logging.WARNING)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        logger.setLevel(level)
+
+
+def measure(run, repeat):
+    """Returns the best wall time of repeat runs, the peak memory of one traced run and the payload of the result."""
+
+    with quiet():
+        times = []
+        for _ in range(repeat):
+            gc.collect()
+            start = time.perf_counter()
+            result = run()
+            times.append(time.perf_counter() - start)
+
+        del result
+        gc.collect()
+        tracemalloc.start()
+        result = run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {"time": min(times), "peak_memory": peak, "payload": payload_size(result)}
+
+
+def run_cases(quick, pattern, repeat):
+    results = {}
+    for case in CASES:
+        if pattern and pattern not in case.name:
+            continue
+        for params in case.params(quick):
+            key = case_key(case.name, params)
+            with quiet():
+                run = case.setup(**params)
+            results[key] = measure(run, repeat)
+            print("%-90s %9.4f s %10.1f MB %s" % (key, results[key]["time"], results[key]["peak_memory"] / 2**20,
+                                                  "" if results[key]["payload"] is None else "%d B" % results[key]["payload"]))
+    return results
+
+
+def run_checks(quick):
+    """Runs the equality checks of the fast paths against their references. Returns the names of the failed ones."""
+
+    failed = []
+    for check in (QUICK_CHECKS if quick else CHECKS):
+        with quiet():
+            error, tolerance = check()
+        ok = error <= tolerance
+        print("%-40s relative error %.3e (tolerance %.0e) %s" % (check.__name__, error, tolerance, "ok" if ok else "FAILED"))
+        if not ok:
+            failed.append(check.__name__)
+    return failed
+
+
+def compare(results, baseline, time_tolerance, memory_tolerance):
+    """Returns the regressions of results against baseline: time or peak memory above tolerance times the baseline,
+    or a larger payload."""
+
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        if result["time"] > time_tolerance * base["time"]:
+            regressions.append("%s: time %.4f s, baseline %.4f s" % (key, result["time"], base["time"]))
+        if result["peak_memory"] > memory_tolerance * base["peak_memory"]:
+            regressions.append("%s: peak memory %.1f MB, baseline %.1f MB" % (key, result["peak_memory"] / 2**20, base["peak_memory"] / 2**20))
+        if result["payload"] is not None and base["payload"] is not None and result["payload"] > base["payload"]:
+            regressions.append("%s: payload %d B, baseline %d B" % (key, result["payload"], base["payload"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="run the small grid only")
+    parser.add_argument("--filter", default="", help="only run the cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs per case")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline file to compare with or to save")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--output", help="also write the results to this file")
+    parser.add_argument("--time-tolerance", type=float, default=1.5, help="flag times above this factor of the baseline")
+    parser.add_argument("--memory-tolerance", type=float, default=1.2, help="flag peak memory above this factor of the baseline")
+    parser.add_argument("--no-checks", action="store_true", help="skip the equality checks")
+    args = parser.parse_args()
+
+    failed = [] if args.no_checks else run_checks(args.quick)
+    results = run_cases(args.quick, args.filter, args.repeat)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"machine": platform.platform(), "results": results}, f, indent=1)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)["results"]
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump({"machine": platform.platform(), "results": baseline}, f, indent=1)
+        print("Saved the baseline of %d cases to %s" % (len(results), args.baseline))
+        regressions = []
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.time_tolerance, args.memory_tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+    else:
+        print("No baseline at %s, run with --save-baseline to record one" % args.baseline)
+        regressions = []
+
+    if failed or regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
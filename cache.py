@@ -0,0 +1,303 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import diskcache
+import numpy as np
+from scipy import sparse
+
+from instrumentation import Observers, Phase, TimingObserver, default_observer
+from tsne import QMatrix, compute_tsne
+
+
+class ResultCache:
+    """
+    Content-addressed on-disk cache of t-SNE runs and explanations.
+
+    Every entry is a directory named after the hash of the input matrix and of the parameters of the run,
+    holding one .npy file per array (memory-mapped when read back) or a single compressed .npz file, and a
+    meta.json describing how to rebuild sparse and on-demand matrices. The total size of the cache is kept
+    under max_bytes by evicting the least recently used entries, except for the entry written last, which
+    stays even when it is larger than max_bytes on its own.
+
+    The directory is shared by the processes of the app (gunicorn workers and background callback workers):
+    writes and evictions hold a lock on its .lock file, released by the system even if the process is killed,
+    while reads take no lock and treat an entry removed under them as a miss.
+
+    Parameters:
+    -----------
+    directory: where the entries are stored
+    max_bytes: size cap of the cache
+    compress: store entries as compressed .npz instead of memory-mappable .npy files
+    """
+
+    def __init__(self, directory = "cache", max_bytes = 2 * 1024**3, compress = False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(X, **params):
+        """Hash of the input matrix and of the parameters (including the random seed) of a run."""
+
+        X = np.ascontiguousarray(X)
+        h = hashlib.sha256()
+        h.update(str((X.shape, X.dtype.str)).encode())
+        h.update(X.tobytes())
+        h.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Returns the dictionary of arrays (and attributes) stored under key, or None, and counts the hit or miss."""
+
+        path = self._path(key)
+        arrays = None
+        # An entry replaced by another process between reading its meta.json and its arrays is read again
+        for _ in range(3):
+            try:
+                with open(os.path.join(path, "meta.json")) as f:
+                    meta = json.load(f)
+                arrays = self._load(path, meta)
+                arrays.update(meta.get("attrs", {}))
+                os.utime(path)
+                break
+            except (FileNotFoundError, NotADirectoryError):
+                arrays = None
+                if not os.path.isdir(path):
+                    break
+
+        with self._lock:
+            if arrays is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return arrays
+
+    def put(self, key, attrs = None, **arrays):
+        """Stores (or extends) the entry key with dense arrays, sparse matrices or tsne.QMatrix objects,
+        and a dictionary attrs of JSON-serializable attributes."""
+
+        with self._locked():
+            self._put(key, attrs or {}, arrays)
+            self._evict(keep=key)
+
+    def _put(self, key, attrs, arrays):
+        path = self._path(key)
+        previous = self.get_meta(key)
+        linked = {}
+        if previous is not None:
+            attrs = {**previous.get("attrs", {}), **attrs}
+            if previous["compress"] or self.compress:
+                arrays = {**self._load(path, previous), **arrays}
+            else:
+                # The unchanged arrays keep their files, linked into the new entry instead of written again
+                linked = {name: info for name, info in previous["arrays"].items() if name not in arrays}
+
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix=".tmp-")
+        meta = {}
+        files = {}
+        for name, info in linked.items():
+            meta[name] = info
+            for stem in _stems(name, info):
+                try:
+                    os.link(os.path.join(path, stem + ".npy"), os.path.join(tmp, stem + ".npy"))
+                except FileNotFoundError:
+                    # The entry was evicted meanwhile, extending it would leave a partial entry
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    return
+                except OSError:
+                    shutil.copyfile(os.path.join(path, stem + ".npy"), os.path.join(tmp, stem + ".npy"))
+        for name, value in arrays.items():
+            if sparse.issparse(value):
+                value = sparse.csr_matrix(value)
+                meta[name] = {"kind": "csr", "shape": list(value.shape)}
+                files[name + ".data"] = value.data
+                files[name + ".indices"] = value.indices
+                files[name + ".indptr"] = value.indptr
+            elif isinstance(value, QMatrix):
+                meta[name] = {"kind": "qmatrix", "sum_Q": float(value.sum_Q)}
+                files[name + ".Y"] = value.Y
+            else:
+                meta[name] = {"kind": "dense"}
+                files[name] = np.asarray(value)
+
+        if self.compress:
+            np.savez_compressed(os.path.join(tmp, "arrays.npz"), **files)
+        else:
+            for name, value in files.items():
+                np.save(os.path.join(tmp, name + ".npy"), value)
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump({"compress": self.compress, "arrays": meta, "attrs": attrs}, f)
+
+        if os.path.exists(path):
+            shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+
+    @contextmanager
+    def _locked(self):
+        """Holds the lock of the cache directory, shared by the threads and the processes using it."""
+
+        with self._lock, open(os.path.join(self.directory, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def get_meta(self, key):
+        try:
+            with open(os.path.join(self._path(key), "meta.json")) as f:
+                return json.load(f)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def _load(self, path, meta):
+        if meta["compress"]:
+            with np.load(os.path.join(path, "arrays.npz")) as npz:
+                files = {name: npz[name] for name in npz.files}
+            read = files.__getitem__
+        else:
+            read = lambda name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+
+        arrays = {}
+        for name, info in meta["arrays"].items():
+            if info["kind"] == "csr":
+                arrays[name] = sparse.csr_matrix((read(name + ".data"), read(name + ".indices"), read(name + ".indptr")),
+                                                 shape=tuple(info["shape"]))
+            elif info["kind"] == "qmatrix":
+                arrays[name] = QMatrix(read(name + ".Y"), info["sum_Q"])
+            else:
+                arrays[name] = read(name)
+        return arrays
+
+    def size(self):
+        """Total size in bytes of the entries of the cache."""
+
+        return sum(size for _, _, size in self._entries())
+
+    def _entries(self):
+        entries = []
+        for key in os.listdir(self.directory):
+            path = self._path(key)
+            if key.startswith(".") or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                entries.append((os.stat(path).st_mtime, key, size))
+            except FileNotFoundError:
+                # Evicted by another process during the scan
+                continue
+        return entries
+
+    def evict(self, keep = None):
+        """Removes the least recently used entries, other than keep, until the cache fits in max_bytes."""
+
+        with self._locked():
+            self._evict(keep)
+
+    def _evict(self, keep):
+        entries = sorted(self._entries())
+        total = sum(size for _, _, size in entries)
+        for _, key, size in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._path(key), ignore_errors=True)
+            total -= size
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries()), "bytes": self.size()}
+
+
+def _stems(name, info):
+    """Names of the .npy files of the array name of an entry, described by info in its meta.json."""
+
+    if info["kind"] == "csr":
+        return [name + ".data", name + ".indices", name + ".indptr"]
+    if info["kind"] == "qmatrix":
+        return [name + ".Y"]
+    return [name]
+
+
+class RunStore(ResultCache):
+    """
+    Server-side store of what the dashboard displays for a run, so that the session store only holds
+    a run id and the callbacks read memory-mapped arrays instead of parsing JSON. The embedding is
+    kept in float32, X stays in float64 since it also feeds the explainer.
+    """
+
+    def save_run(self, run_id, X, Y, labels, feature_names, nb_classes, dataset_name, n_iter = None, timings = None):
+        labels = np.asarray(labels)
+        if labels.dtype == object:
+            labels = labels.astype(str)
+        self.put(run_id, X=X, embedding=np.asarray(Y, dtype=np.float32), labels=labels,
+                 attrs={"feature_names": list(feature_names), "nb_classes": nb_classes, "dataset_name": dataset_name,
+                        "n_iter": n_iter, "timings": timings or []})
+
+    def load_run(self, run_id):
+        """Returns the dictionary with X, embedding, labels, feature_names, nb_classes, dataset_name, n_iter and
+        timings (see instrumentation.TimingObserver.breakdown), or None."""
+
+        if run_id is None:
+            return None
+        return self.get(run_id)
+
+
+result_cache = ResultCache(os.path.join("cache", "results"))
+run_store = RunStore(os.path.join("cache", "runs"))
+job_cache = diskcache.Cache(os.path.join("cache", "jobs"))
+
+
+def cached_tsne(cache, X, seed = 0, progress = None, snapshot = None, snapshot_every = 10, observer = None, **params):
+    """
+    Runs compute_tsne(X, seed=seed, progress=progress, snapshot=snapshot, snapshot_every=snapshot_every,
+    observer=observer, **params) through the cache. A run stopped early by snapshot is stored under its own key,
+    which records the iteration it stopped at. The observer is not part of the key; it also receives the
+    "cache lookup" phase, and the timing breakdown of the phases of the computation is stored with the run
+    as the attribute timings.
+
+    A dense Q is replaced by the tsne.QMatrix of the final embedding, so that an entry only holds one NxN array.
+
+    Return:
+    -------
+    key: content address of the run, usable as a run id
+    Y, P, Q, sigma: outputs of compute_tsne
+    n_iter: number of iterations the optimization actually ran
+    timings: breakdown of the phases of the computation (see instrumentation.TimingObserver.breakdown),
+    from the run that filled the entry on a hit
+    """
+    key = cache.key(X, seed=seed, **params)
+    with Phase(observer, "cache lookup"):
+        arrays = cache.get(key)
+    if arrays is None:
+        stopped_at = []
+        def watch(iteration, Y, cost):
+            stop = snapshot(iteration, Y, cost)
+            if stop and iteration < params.get("max_iter", 400):
+                stopped_at.append(iteration)
+            return stop
+
+        timing = TimingObserver()
+        Y, P, Q, sigma, n_iter = compute_tsne(X, seed=seed, progress=progress, snapshot=watch if snapshot is not None else None,
+                                              snapshot_every=snapshot_every, return_n_iter=True,
+                                              observer=Observers(timing, observer if observer is not None else default_observer),
+                                              **params)
+        if stopped_at:
+            key = cache.key(X, seed=seed, stopped_at=stopped_at[0], **params)
+        if isinstance(Q, np.ndarray):
+            Q = QMatrix.of_embedding(Y)
+        timings = timing.breakdown()
+        cache.put(key, Y=Y, P=P, Q=Q, sigma=sigma, attrs={"n_iter": n_iter, "timings": timings})
+        return key, Y, P, Q, sigma, n_iter, timings
+    return key, arrays["Y"], arrays["P"], arrays["Q"], arrays["sigma"], arrays.get("n_iter"), arrays.get("timings", [])
+
@@ -0,0 +1,229 @@
+import base64
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn import datasets
+
+
+class DatasetRegistry:
+    """
+    Registry of the datasets the app can embed, each converted once into memory-mapped .npy arrays.
+
+    Every dataset is a directory holding X.npy (float64, standardized when asked), labels.npy and a meta.json
+    with the feature names, the number of classes and the fingerprint of the source it was converted from.
+    Loading a dataset memory-maps its arrays, so it costs the same whatever its size; a dataset whose source
+    file changed (or, for the sklearn datasets, whose sklearn version changed) is converted again.
+    CSV files, bundled or uploaded, are parsed in chunks of rows, so they never have to fit in memory.
+
+    Parameters:
+    -----------
+    directory: where the converted datasets are stored
+    chunksize: number of CSV rows parsed at a time
+    """
+
+    def __init__(self, directory = "cache", chunksize = 10000):
+        self.directory = directory
+        self.chunksize = chunksize
+        self.sources = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def register(self, name, label, path = None, loader = None, version = None, nb_classes = 1, **csv_options):
+        """
+        Declares the dataset name, shown as label, read from the CSV file at path (see ingest_csv, which takes
+        the csv_options) or returned by loader() as (X, labels, feature_names). version identifies the source of
+        a loader, whose dataset is converted again when it changes.
+        """
+        self.sources[name] = {"label": label, "path": path, "loader": loader, "version": version,
+                              "nb_classes": nb_classes, "csv_options": csv_options}
+
+    def options(self):
+        """Options of the dataset dropdown: the registered datasets, then the uploaded ones."""
+
+        options = [{"label": source["label"], "value": name} for name, source in self.sources.items()]
+        for name in sorted(os.listdir(self.directory)):
+            meta = self.get_meta(name)
+            if name not in self.sources and meta is not None and meta.get("upload"):
+                options.append({"label": meta["label"], "value": name})
+        return options
+
+    def get_meta(self, name):
+        try:
+            with open(os.path.join(self._path(name), "meta.json")) as f:
+                return json.load(f)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def load(self, name):
+        """
+        Returns the dictionary with X, labels, feature_names, nb_classes and label of the dataset name,
+        converting it first if needed, or None for an unknown dataset.
+        """
+        meta = self.get_meta(name)
+        source = self.sources.get(name)
+        if source is not None and (meta is None or meta["fingerprint"] != self._fingerprint(source)):
+            with self._lock:
+                meta = self.get_meta(name)
+                if meta is None or meta["fingerprint"] != self._fingerprint(source):
+                    self._convert(name, source)
+                    meta = self.get_meta(name)
+        if meta is None:
+            return None
+
+        path = self._path(name)
+        return {"X": np.load(os.path.join(path, "X.npy"), mmap_mode="r"),
+                "labels": np.load(os.path.join(path, "labels.npy"), mmap_mode="r"),
+                "feature_names": meta["feature_names"], "nb_classes": meta["nb_classes"], "label": meta["label"]}
+
+    def upload(self, filename, contents, **csv_options):
+        """
+        Converts the CSV file uploaded through a dcc.Upload (contents being its base64 data URL) into a dataset,
+        named after the file, and returns this name.
+        """
+        label = os.path.splitext(os.path.basename(filename))[0]
+        name = "upload-" + re.sub(r"[^A-Za-z0-9_-]+", "-", label).strip("-").lower()
+
+        # The file is decoded to disk by slices of a multiple of 4 characters, each of which decodes on its own
+        with tempfile.TemporaryFile(dir=self.directory) as f:
+            block = 4 * 2**20
+            for start in range(contents.index(",") + 1, len(contents), block):
+                f.write(base64.b64decode(contents[start:start + block]))
+            f.seek(0)
+            self.ingest_csv(name, f, label, upload=True, **csv_options)
+        return name
+
+    def ingest_csv(self, name, source, label, index_col = 0, drop = (), scale = True, nb_classes = 1,
+                   fingerprint = None, upload = False):
+        """
+        Converts the CSV file source (a path or a binary file object) into the dataset name, chunksize rows at
+        a time. The index column gives the labels (the row numbers when index_col is None), the numeric and
+        boolean columns of the first rows other than drop give the features, and the features are
+        standardized with scale. The mean and variance are accumulated chunk by chunk while the raw values
+        are spilled to disk, then the standardized values are written into the memory-mapped X.npy.
+        """
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix=".tmp-")
+        try:
+            raw_path = os.path.join(tmp, "raw.bin")
+            n, mean, M2 = 0, None, None
+            columns, labels = None, []
+            with open(raw_path, "wb") as raw:
+                for chunk in pd.read_csv(source, index_col=index_col, chunksize=self.chunksize):
+                    chunk = chunk.drop(columns=[c for c in drop if c in chunk.columns])
+                    if columns is None:
+                        columns = chunk.select_dtypes(include=["number", "bool"]).columns.tolist()
+                        if not columns:
+                            raise ValueError("The CSV file has no numeric column.")
+                    block = chunk[columns].to_numpy(dtype=np.float64)
+                    raw.write(block.tobytes())
+                    labels.append(chunk.index.to_numpy() if index_col is not None else np.arange(n, n + block.shape[0]))
+
+                    # Merge the mean and sum of squared deviations of the chunk (Chan et al.)
+                    nb = block.shape[0]
+                    mean_b = block.mean(axis=0)
+                    M2_b = np.sum(np.square(block - mean_b), axis=0)
+                    if mean is None:
+                        mean, M2 = mean_b, M2_b
+                    else:
+                        delta = mean_b - mean
+                        mean = mean + delta * nb / (n + nb)
+                        M2 = M2 + M2_b + np.square(delta) * n * nb / (n + nb)
+                    n += nb
+            if n == 0:
+                raise ValueError("The CSV file has no row.")
+
+            # Features of zero variance are only centered, as by sklearn's StandardScaler
+            std = np.sqrt(M2 / n)
+            std[std < 10 * np.finfo(np.float64).eps] = 1.0
+            raw = np.memmap(raw_path, dtype=np.float64, mode="r", shape=(n, len(columns)))
+            X = np.lib.format.open_memmap(os.path.join(tmp, "X.npy"), mode="w+", dtype=np.float64, shape=(n, len(columns)))
+            for start in range(0, n, self.chunksize):
+                rows = raw[start:start + self.chunksize]
+                X[start:start + self.chunksize] = (rows - mean) / std if scale else rows
+            X.flush()
+            del X, raw
+            os.remove(raw_path)
+
+            labels = np.concatenate(labels)
+            self._finish(tmp, name, labels, {"label": label, "feature_names": [str(c) for c in columns],
+                                             "nb_classes": nb_classes, "fingerprint": fingerprint, "upload": upload})
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    def ingest_arrays(self, name, X, labels, feature_names, label, nb_classes = 1, fingerprint = None, scale = False):
+        """Stores the in-memory dataset X (with its labels and feature names) as the dataset name."""
+
+        X = np.asarray(X, dtype=np.float64)
+        if scale:
+            std = X.std(axis=0)
+            std[std < 10 * np.finfo(np.float64).eps] = 1.0
+            X = (X - X.mean(axis=0)) / std
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix=".tmp-")
+        try:
+            np.save(os.path.join(tmp, "X.npy"), X)
+            self._finish(tmp, name, np.asarray(labels), {"label": label, "feature_names": list(feature_names),
+                                                        "nb_classes": nb_classes, "fingerprint": fingerprint,
+                                                        "upload": False})
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    def _finish(self, tmp, name, labels, meta):
+        if labels.dtype == object:
+            labels = labels.astype(str)
+        np.save(os.path.join(tmp, "labels.npy"), labels)
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        path = self._path(name)
+        if os.path.exists(path):
+            shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+
+    def _convert(self, name, source):
+        fingerprint = self._fingerprint(source)
+        if source["path"] is not None:
+            self.ingest_csv(name, source["path"], source["label"], nb_classes=source["nb_classes"],
+                            fingerprint=fingerprint, **source["csv_options"])
+        else:
+            X, labels, feature_names = source["loader"]()
+            self.ingest_arrays(name, X, labels, feature_names, source["label"], source["nb_classes"], fingerprint,
+                               **source["csv_options"])
+
+    @staticmethod
+    def _fingerprint(source):
+        """Identifies the version of a source: size and modification time of its file, or its version."""
+
+        if source["path"] is not None:
+            stat = os.stat(source["path"])
+            return [os.path.abspath(source["path"]), stat.st_size, stat.st_mtime_ns]
+        return source["version"]
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+
+def _load_iris():
+    iris = datasets.load_iris()
+    return iris.data, iris.target, iris.feature_names
+
+
+def _load_diabetes():
+    diabetes = datasets.load_diabetes()
+    return diabetes.data, diabetes.target, diabetes.feature_names
+
+
+dataset_registry = DatasetRegistry(os.path.join("cache", "datasets"))
+
+# The datasets keep the scaling the app always used: only the countries are standardized
+dataset_registry.register("iris", "Iris", loader=_load_iris, version=sklearn.__version__, nb_classes=3)
+dataset_registry.register("diabetes", "Diabetes", loader=_load_diabetes, version=sklearn.__version__)
+dataset_registry.register("countries", "Countries", path=os.path.join("datasets", "country_dataset_with_names.csv"))
+dataset_registry.register("zoo", "Zoo", path=os.path.join("datasets", "zoo.csv"), drop=["class_type"], scale=False)
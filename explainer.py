@@ -1,42 +1,489 @@
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
 import numpy as np
 import pandas as pd
 import plotly.figure_factory as ff
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
+from scipy import sparse
 from scipy.stats import hmean
 from sklearn.metrics import pairwise_distances
+from sklearn.neighbors import NearestNeighbors
+from threadpoolctl import threadpool_info, threadpool_limits
 
+from instrumentation import Phase
+from tsne import QMatrix, _block_rows, transform_tsne
 
-def compute_all_gradients(X, Y, P, Q, sigma):
-    gradients = []
-    for i in range(X.shape[0]):
-        gradients.append(compute_gradients(X, Y, P, Q, sigma, i))
-    
-    gradients = np.array(gradients)
-    
-    return gradients
 
-def compute_gradients(X, Y, P, Q, sigma, i):
+class ExplainerContext:
+    """
+    Quantities shared by the explanations of every instance of an embedding, computed once per embedding
+    instead of once per instance.
+
+    Parameters:
+    -----------
+    X: instances in high-dimensional space
+    Y: embedding in low-dimensional space
+    P: p-values of t-sne
+    Q: q-values of t-sne
+    sigma: sigma values found by t-sne with the chosen perplexity
+    S_q, S_pj: shared quantities computed by another context, computed from X and Y when not given
+    memory_budget: bytes of the temporaries of S_q and S_pj, computed by blocks of rows so that no NxN
+    array is allocated (P and a dense Q are the only ones, when given as such)
+    """
+
+    def __init__(self, X, Y, P, Q, sigma, S_q=None, S_pj=None, memory_budget=64 * 2**20):
+        self.X = X
+        self.Y = Y
+        self.P = P
+        self.Q = Q
+        self.sigma = sigma.reshape((X.shape[0],))
+
+        n = X.shape[0]
+        block = _block_rows(n, memory_budget, 3)
+        if S_q is None:
+            S_q = Q.sum_Q if isinstance(Q, QMatrix) else QMatrix.of_embedding(Y, block).sum_Q
+        if S_pj is None:
+            S_pj = np.empty(n)
+            for start in range(0, n, block):
+                end = min(start + block, n)
+                distances = pairwise_distances(X[start:end], X, squared=True)
+                distances[np.arange(end - start), np.arange(start, end)] = 0
+                S_pj[start:end] = np.exp( - distances / ( 2*(self.sigma[start:end, np.newaxis]**2) ) ).sum(axis=1) - 1 # on enlève la diagonale (quand j = l)
+        self.S_q = S_q
+        self.S_pj = S_pj
+
+
+class ExplanationProvider:
+    """
+    Lazy provider of the explanations of a t-SNE run: the shared ExplainerContext is computed once,
+    and the saliency of an instance only when it is first requested. Results are kept in an LRU cache
+    shared by all runs, keyed by (run_id, instance) and holding at most cache_bytes bytes of saliencies
+    (an instance of a run with m embedding and d input dimensions takes m * d * 8 bytes). The missing
+    saliencies are computed chunk_size instances at a time, as by compute_all_gradients.
+
+    Parameters:
+    -----------
+    X, Y, P, Q, sigma: inputs and outputs of the t-SNE run, as for compute_all_gradients
+    run_id: identifier of the run, generated when not given
+    observer: instrumentation.Observer receiving the "explainer context" phase and every batch of
+    saliencies computed as an "explanations" phase, instrumentation.default_observer when None
+    resources: resources.ComputeResources giving every batch of saliencies computed its share of the threads
+    cache: cache.ResultCache holding the run under run_id, into whose entry the feature importance and the
+    saliencies computed are persisted, so that a provider rebuilt for the run does not compute them again
+    """
+
+    cache_bytes = 256 * 2**20
+    chunk_size = 128
+    _cache = OrderedDict()
+    _cache_nbytes = 0
+    _lock = threading.Lock()
+
+    def __init__(self, X, Y, P, Q, sigma, run_id=None, observer=None, resources=None, cache=None):
+        self.run_id = run_id if run_id is not None else uuid.uuid4().hex
+        self.observer = observer
+        self.resources = resources
+        self.cache = cache
+        with Phase(observer, "explainer context"):
+            self.context = ExplainerContext(X, Y, P, Q, sigma)
+        self.n = X.shape[0]
+        self._feature_importance = None
+
+        # Saliencies persisted for the run: (instance -> row of explained_gradients, explained_gradients)
+        self._stored = ({}, None)
+        self._stored_lock = threading.Lock()
+        entry = cache.get(self.run_id) if cache is not None else None
+        if entry is not None:
+            self._feature_importance = entry.get("feature_importance")
+            if "explained" in entry:
+                self._stored = ({int(i): k for k, i in enumerate(entry["explained"])}, entry["explained_gradients"])
+
+    def gradients(self, idx):
+        """
+        Function that returns the saliencies of the instances idx, computing the missing ones by chunks
+
+        Return:
+        -------
+        gradients: (len(idx), m, d) t-sne "saliencies"
+        """
+        idx = np.asarray(idx, dtype=int).reshape(-1)
+        gradients = np.empty((idx.shape[0], self.context.Y.shape[1], self.context.X.shape[1]))
+
+        missing = []
+        stored, stored_gradients = self._stored
+        with self._lock:
+            for k, i in enumerate(idx):
+                key = (self.run_id, int(i))
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    gradients[k] = self._cache[key]
+                elif int(i) in stored:
+                    gradients[k] = stored_gradients[stored[int(i)]]
+                    self._remember(key, gradients[k].copy())
+                else:
+                    missing.append(k)
+
+        if missing:
+            # The batches build (chunk_size, n, d) stacks, so the instances are never solved all together
+            todo = np.unique(idx[missing])
+            computed = np.empty((todo.shape[0],) + gradients.shape[1:])
+            with self._job():
+                for start in range(0, todo.shape[0], self.chunk_size):
+                    chunk = todo[start:start + self.chunk_size]
+                    with Phase(self.observer, "explanations", chunk="%d instances" % chunk.shape[0]):
+                        computed[start:start + chunk.shape[0]] = _compute_gradients_batch(self.context, chunk)
+            gradients[missing] = computed[np.searchsorted(todo, idx[missing])]
+            self._store(todo, computed)
+
+            with self._lock:
+                for i, g in zip(todo, computed):
+                    self._remember((self.run_id, int(i)), g.copy())
+
+        return gradients
+
+    def _remember(self, key, g):
+        # Called with the lock held; the copies stored do not keep their whole batch alive
+        cls = ExplanationProvider
+        previous = cls._cache.pop(key, None)
+        if previous is not None:
+            cls._cache_nbytes -= previous.nbytes
+        cls._cache[key] = g
+        cls._cache_nbytes += g.nbytes
+        while cls._cache_nbytes > self.cache_bytes and len(cls._cache) > 1:
+            cls._cache_nbytes -= cls._cache.popitem(last=False)[1].nbytes
+
+    def _store(self, idx, computed):
+        # Only extends an entry still in the cache: a new one without the run would be of no use
+        if self.cache is None or self.cache.get_meta(self.run_id) is None:
+            return
+        with self._stored_lock:
+            stored, stored_gradients = self._stored
+            new = np.array([i for i in idx if int(i) not in stored], dtype=int)
+            if new.shape[0] == 0:
+                return
+            computed = computed[np.searchsorted(idx, new)]
+            if stored_gradients is not None:
+                explained = np.concatenate([np.fromiter(stored, dtype=int, count=len(stored)), new])
+                computed = np.concatenate([stored_gradients, computed])
+            else:
+                explained = new
+            self.cache.put(self.run_id, explained=explained, explained_gradients=computed)
+            self._stored = ({int(i): k for k, i in enumerate(explained)}, computed)
+
+    def _job(self):
+        if self.resources is None:
+            return nullcontext()
+        return self.resources.job("explanations")
+
+    def transform(self, X_new, return_gradients=False, **params):
+        """
+        Function that places new instances into the embedding of the run with tsne.transform_tsne,
+        which takes the other params
+
+        Return:
+        -------
+        Y_new: embedding of the new instances
+        gradients: (len(X_new), m, d) t-sne "saliencies" of the new instances, with return_gradients
+        """
+        X, Y = self.context.X, self.context.Y
+        params.setdefault("observer", self.observer)
+        Y_new, P_new, sigma_new = transform_tsne(X_new, X, Y, **params)
+        if not return_gradients:
+            return Y_new
+        return Y_new, compute_transform_gradients(X, Y, X_new, Y_new, P_new, sigma_new)
+
+    def feature_importance(self, sample_size=256, seed=0):
+        """
+        Function that estimates the global feature importance of create_feature_importance_ranking_plot
+        from the saliencies of a random sample of instances, instead of from all of them
+
+        Return:
+        -------
+        mean_norms: importance of every feature
+        """
+        if self._feature_importance is None:
+            if self.n <= sample_size:
+                idx = np.arange(self.n)
+            else:
+                idx = np.sort(np.random.default_rng(seed).choice(self.n, sample_size, replace=False))
+            norms = np.linalg.norm(self.gradients(idx), axis=1)
+            norms = norms / np.sum(norms, axis=1, keepdims=True)
+            self._feature_importance = (self.n / idx.shape[0]) * np.sum(norms, axis=0) / norms.shape[1]
+            if self.cache is not None and self.cache.get_meta(self.run_id) is not None:
+                self.cache.put(self.run_id, feature_importance=self._feature_importance)
+        return self._feature_importance
+
+
+_providers = OrderedDict()
+_providers_lock = threading.Lock()
+MAX_PROVIDERS = 16
+
+def register_provider(provider):
+    """
+    Function that makes a provider available to the dashboard callbacks under its run_id,
+    forgetting the least recently registered ones beyond MAX_PROVIDERS
+    """
+    with _providers_lock:
+        _providers[provider.run_id] = provider
+        _providers.move_to_end(provider.run_id)
+        while len(_providers) > MAX_PROVIDERS:
+            _providers.popitem(last=False)
+    return provider.run_id
+
+def get_provider(run_id):
+    """
+    Function that returns the provider registered under run_id, or None
+    """
+    with _providers_lock:
+        return _providers.get(run_id)
+
+def compute_all_gradients(X, Y, P, Q, sigma, chunk_size=128, n_jobs=1, observer=None, resources=None):
+    """
+    Function that compute the saliency of every instance, chunk_size instances at a time.
+
+    The Hessians and cross-derivatives of a chunk are formed as (chunk_size, m, m) and (chunk_size, m, d)
+    stacks and solved together, so peak memory grows with chunk_size * n * max(m, d).
+    With n_jobs > 1, the chunks are spread over a pool of n_jobs worker processes that read the inputs
+    from shared memory and write into a shared output array, the BLAS threads of the calling process
+    being split between the workers.
+    With resources (a resources.ComputeResources), the saliencies are computed as one of its jobs, and it is
+    the share of the threads of this job that is split between the workers.
+    The context and every chunk (all of them together with n_jobs > 1) are reported to observer as the
+    "explainer context" and "explanations" phases (see instrumentation.Observer).
+
+    Return:
+    -------
+    gradients: (n, m, d) t-sne "saliencies"
+    """
+    with Phase(observer, "explainer context"):
+        context = ExplainerContext(X, Y, P, Q, sigma)
+    n = X.shape[0]
+
+    with resources.job("explanations") if resources is not None else nullcontext():
+        if n_jobs > 1:
+            if resources is not None:
+                threads = resources.worker_threads(n_jobs)
+            else:
+                threads = max(1, max([pool['num_threads'] for pool in threadpool_info()], default=1) // n_jobs)
+            with Phase(observer, "explanations", jobs=n_jobs):
+                return _compute_all_gradients_parallel(context, chunk_size, n_jobs, threads)
+
+        gradients = np.empty((n, Y.shape[1], X.shape[1]))
+
+        for start in range(0, n, chunk_size):
+            idx = np.arange(start, min(start + chunk_size, n))
+            with Phase(observer, "explanations", chunk="%d-%d of %d" % (start, idx[-1] + 1, n)):
+                gradients[idx] = _compute_gradients_batch(context, idx)
+
+        return gradients
+
+def _share(array, blocks):
+    """
+    Function that copies an array into a new shared memory block and returns what is needed to attach it
+    """
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    blocks.append(shm)
+    np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+    return (shm.name, array.shape, array.dtype.str)
+
+def _share_matrix(M, blocks):
+    """
+    Function that shares a dense, sparse (CSR) or on-demand (tsne.QMatrix) P or Q matrix
+    """
+    if sparse.issparse(M):
+        M = sparse.csr_matrix(M)
+        return ('csr', _share(M.data, blocks), _share(M.indices, blocks), _share(M.indptr, blocks), M.shape)
+    if isinstance(M, QMatrix):
+        return ('q', _share(M.Y, blocks), M.sum_Q)
+    return ('dense', _share(M, blocks))
+
+_worker_state = {}
+
+def _attach(spec):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    _worker_state.setdefault('blocks', []).append(shm)
+    return np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+
+def _attach_matrix(spec):
+    if spec[0] == 'csr':
+        return sparse.csr_matrix((_attach(spec[1]), _attach(spec[2]), _attach(spec[3])), shape=spec[4], copy=False)
+    if spec[0] == 'q':
+        return QMatrix(_attach(spec[1]), spec[2])
+    return _attach(spec[1])
+
+def _init_worker(specs):
+    """
+    Function that attaches a worker process to the shared inputs and output of compute_all_gradients
+    """
+    _worker_state['limits'] = threadpool_limits(limits=specs['threads'])
+    X, Y, sigma, S_pj, gradients = [_attach(specs[key]) for key in ('X', 'Y', 'sigma', 'S_pj', 'gradients')]
+    P, Q = _attach_matrix(specs['P']), _attach_matrix(specs['Q'])
+    _worker_state['context'] = ExplainerContext(X, Y, P, Q, sigma, specs['S_q'], S_pj)
+    _worker_state['gradients'] = gradients
+
+def _explain_chunk(start, end):
+    idx = np.arange(start, end)
+    _worker_state['gradients'][idx] = _compute_gradients_batch(_worker_state['context'], idx)
+
+def _compute_all_gradients_parallel(context, chunk_size, n_jobs, threads):
+    """
+    Function that spreads the chunks of compute_all_gradients over a pool of worker processes,
+    each limited to threads BLAS threads
+    """
+    n = context.X.shape[0]
+    blocks = []
+    try:
+        specs = {
+            'X': _share(context.X, blocks),
+            'Y': _share(context.Y, blocks),
+            'sigma': _share(context.sigma, blocks),
+            'S_pj': _share(context.S_pj, blocks),
+            'S_q': context.S_q,
+            'P': _share_matrix(context.P, blocks),
+            'Q': _share_matrix(context.Q, blocks),
+            'gradients': _share(np.empty((n, context.Y.shape[1], context.X.shape[1])), blocks),
+            'threads': threads,
+        }
+        starts = list(range(0, n, chunk_size))
+        ends = [min(start + chunk_size, n) for start in starts]
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(specs,)) as executor:
+            list(executor.map(_explain_chunk, starts, ends))
+
+        name, shape, dtype = specs['gradients']
+        return np.ndarray(shape, np.dtype(dtype), buffer=blocks[-1].buf).copy()
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+def _compute_gradients_batch(context, idx):
+    """
+    Function that compute the saliencies of a batch of instances with a single batched linear solve.
+
+    Parameters:
+    -----------
+    context: ExplainerContext of the embedding
+    idx: indices of the inputs to consider
+
+    Return:
+    -------
+    derivative: (len(idx), m, d) t-sne "saliencies"
+    """
+    y2_derivative = _compute_y2_derivative_batch(idx, context)
+
+    yx_derivative = _compute_xy_derivative_batch(idx, context)
+
+    return -np.linalg.solve(y2_derivative, np.swapaxes(yx_derivative, 1, 2))
+
+def _compute_y2_derivative_batch(idx, context):
+    """
+    Function that compute the second derivatives of t-sne regarding y_i for a batch of instances,
+    as a (len(idx), m, m) stack (see _compute_y2_derivative)
+    """
+    y = context.Y
+    c = idx.shape[0]
+    m = y.shape[1]
+    S_q = context.S_q
+
+    d_ij = y[idx][:, np.newaxis, :] - y
+    d_ij_T = np.swapaxes(d_ij, 1, 2)
+
+    e_ij = 1 + np.sum(d_ij**2, axis=2)
+    E_ij = 1/e_ij
+
+    S_q_d = -4 * np.einsum('cn,cnm->cm', E_ij**2, d_ij)
+
+    v_ij = _rows(context.P, idx) - _rows(context.Q, idx)
+    v_ij_d = ( ( 2 * d_ij_T * (E_ij**2 * S_q)[:, np.newaxis, :] ) + ( S_q_d[:, :, np.newaxis] / e_ij[:, np.newaxis, :] ) ) / ( S_q**2 )
+
+    term1 = (v_ij_d * E_ij[:, np.newaxis, :]) @ d_ij
+    term2 = (2 * d_ij_T * (v_ij * E_ij**2)[:, np.newaxis, :]) @ d_ij
+    ve = v_ij * E_ij
+    term3 = (ve.sum(axis=1) - ve[np.arange(c), idx])[:, np.newaxis, np.newaxis] * np.identity(m)
+
+    return 4 * ( term1 - term2 + term3 )
+
+def _compute_xy_derivative_batch(idx, context):
+    """
+    Function that compute the second derivatives of t-sne regarding x_i for a batch of instances,
+    as a (len(idx), d, m) stack (see _compute_xy_derivative)
+    """
+    X = context.X
+    y = context.Y
+    sigma = context.sigma
+    S_pj = context.S_pj
+    n = X.shape[0]
+    c = idx.shape[0]
+    sigma_i = sigma[idx][:, np.newaxis]
+
+    y_ij = y[idx][:, np.newaxis, :] - y
+    x_ij = X[idx][:, np.newaxis, :] - X
+    x_ji = -x_ij
+    E_ij = 1/(1 + np.sum(y_ij**2, axis=2))
+
+    dist_ij = np.sum(x_ij**2, axis=2)
+    exp_ij = np.exp( -( dist_ij / (2*(sigma_i**2)) ) )
+    exp_ji = np.exp( -( dist_ij / (2*(sigma**2)) ) )
+
+    S_pi = (exp_ij.sum(axis=1) - exp_ij[np.arange(c), idx])[:, np.newaxis]
+
+    S_pi_d = -(sigma_i**(-2)) * np.einsum('cn,cnd->cd', exp_ij, x_ij)
+
+    S_pj_d = (sigma**(-2) * exp_ji)[:, :, np.newaxis] * x_ji
+
+    P_ji_d = ( ( -S_pi[:, :, np.newaxis] * x_ij * (sigma_i**(-2) * exp_ij)[:, :, np.newaxis] ) - ( exp_ij[:, :, np.newaxis] * S_pi_d[:, np.newaxis, :] ) ) / (S_pi**2)[:, :, np.newaxis]
+    P_ij_d = ( ( (S_pj * sigma**(-2) * exp_ji)[:, :, np.newaxis] * x_ji ) - ( exp_ji[:, :, np.newaxis] * S_pj_d ) ) / (S_pj**2)[np.newaxis, :, np.newaxis]
+
+    v_ij_d = (1 / (2*n)) * (P_ji_d + P_ij_d)
+
+    return 4 * np.einsum('cnd,cnm->cdm', v_ij_d, y_ij * E_ij[:, :, np.newaxis])
+
+def compute_gradients(X, Y, P, Q, sigma, i, context=None):
     """
     Function that compute the saliency for an image X and output y.
 
     Parameters:
     -----------
     i: indice of the input to consider
+    context: ExplainerContext of the embedding, built on the fly when not given
     
     Return:
     -------
     derivative: t-sne "saliency"
     """
-    y2_derivative = _compute_y2_derivative(i, Y, P, Q)
+    if context is None:
+        context = ExplainerContext(X, Y, P, Q, sigma)
+
+    y2_derivative = _compute_y2_derivative(i, Y, P, Q, context.S_q)
     
-    yx_derivative = _compute_xy_derivative(i, X, Y, sigma)
+    yx_derivative = _compute_xy_derivative(i, X, Y, context.sigma, context.S_pj)
     
     derivative = (-np.linalg.inv(y2_derivative)) @ (yx_derivative.T)
 
     return derivative
 
-def _compute_y2_derivative(i, y, P, Q):
+def _rows(M, rows):
+    """
+    Function that returns rows of a dense, sparse or on-demand (tsne.QMatrix) matrix as a dense array
+    """
+    if sparse.issparse(M):
+        return M[rows].toarray()
+    return np.asarray(M[rows])
+
+def _row(M, i):
+    """
+    Function that returns a row of a dense, sparse or on-demand (tsne.QMatrix) matrix as a dense vector
+    """
+    return _rows(M, np.array([i]))[0]
+
+def _compute_y2_derivative(i, y, P, Q, S_q=None):
     """
     Function that compute the second derivative of t-sne regarding y_i
     
@@ -46,6 +493,7 @@ def _compute_y2_derivative(i, y, P, Q):
     y: low-dimensional space embedding
     P: p-values of t-sne
     Q: q-values of t-sne
+    S_q: normalization of the q-values, computed from y when not given
     
     Return:
     -------
@@ -62,11 +510,12 @@ def _compute_y2_derivative(i, y, P, Q):
     e_ij_d = 2 * d_ij
     E_ij = 1/e_ij
 
-    distances = 1 + pairwise_distances(y, squared=True) # refactor e_ij with this maybe
-    S_q = np.sum( 1/distances ) - np.trace(1/distances)
+    if S_q is None:
+        distances = 1 + pairwise_distances(y, squared=True) # refactor e_ij with this maybe
+        S_q = np.sum( 1/distances ) - np.trace(1/distances)
     S_q_d = -4 * np.sum((e_ij**(-2)).reshape(1, n) @ d_ij, axis=0)
     
-    v_ij = (P - Q)[i]     
+    v_ij = _row(P, i) - _row(Q, i)
     v_ij_d = ( ( e_ij_d.T * e_ij**(-2) * S_q ) + ( S_q_d.reshape(m, 1) / e_ij.reshape(1, n) ) ) / ( S_q**2 )
     
     term1 = (v_ij_d * E_ij.reshape(1, n)) @ d_ij
@@ -75,7 +524,7 @@ def _compute_y2_derivative(i, y, P, Q):
     
     return 4 * ( term1 - term2 + term3 ) 
     
-def _compute_xy_derivative(i, X, y, sigma):
+def _compute_xy_derivative(i, X, y, sigma, S_pj=None):
     """
     Function that compute the second derivative of t-sne regarding x_i
 
@@ -85,6 +534,7 @@ def _compute_xy_derivative(i, X, y, sigma):
     X: instances in high-dimensional space
     y: embedding in low-dimensional space 
     sigma: sigma values found by t-sne with the chosen perplexity 
+    S_pj: normalizations of the conditional p-values p_j|l, computed from X when not given
     
     Return:
     -------
@@ -109,7 +559,8 @@ def _compute_xy_derivative(i, X, y, sigma):
     S_pi_d = (- (x_ij) * (sigma[i]**(-2)) * exp_ij.reshape(n, 1)).sum(axis=0)
     S_pi_d = np.tile(S_pi_d , (n, 1))
     
-    S_pj = ((np.exp( - pairwise_distances(X, squared=True) / ( 2*(sigma**2) ) )).sum(axis=0)) - 1 # on enlève la diagonale (quand j = l)
+    if S_pj is None:
+        S_pj = ((np.exp( - pairwise_distances(X, squared=True) / ( 2*(sigma**2) ) )).sum(axis=0)) - 1 # on enlève la diagonale (quand j = l)
     S_pj_d = (sigma**(-2) * exp_ji).reshape(n,1) * x_ji
 
     P_ji_d = ( ( -S_pi * x_ij * sigma[i]**(-2) * exp_ij.reshape(n, 1)) - ( exp_ij.reshape(n, 1) * S_pi_d ) ) / S_pi**2
@@ -120,3 +571,230 @@ def _compute_xy_derivative(i, X, y, sigma):
     # return 4 * np.delete( ((v_ij_d * E_ij).reshape(n, 1, 1) * y_ij), i, axis=0).sum(axis=0)
     return 4 * ( v_ij_d.T @ ( y_ij * E_ij.reshape(n, 1) ) )
 
+class TruncatedExplainerContext:
+    """
+    Quantities shared by the neighbourhood-truncated explanations of an embedding. The sums of the
+    explanation of instance i only run over the n_neighbors nearest neighbours of i in X and in Y,
+    found with spatial indexes, so that explaining an instance costs O(k*d) instead of O(n*d).
+
+    Parameters:
+    -----------
+    X: instances in high-dimensional space
+    Y: embedding in low-dimensional space
+    P: p-values of t-sne (dense or sparse)
+    Q: q-values of t-sne, as given to compute_gradients: a dense matrix, whose entries are used as they are
+    (compute_tsne returns the Q of the embedding before its last update), a tsne.QMatrix, of which only the
+    normalization is needed, or None to compute the exact normalization from Y by blocks of rows
+    sigma: sigma values found by t-sne with the chosen perplexity
+    n_neighbors: size of the neighbourhoods in X and in Y
+    tail_sample: number of points outside the neighbourhood sampled to estimate the truncation error
+    """
+
+    def __init__(self, X, Y, P, Q, sigma, n_neighbors=100, tail_sample=128, seed=0):
+        n = X.shape[0]
+        self.X = X
+        self.Y = Y
+        self.P = P
+        self.sigma = sigma.reshape((n,))
+        self.tail_sample = tail_sample
+        self.rng = np.random.default_rng(seed)
+        k = min(n - 1, n_neighbors)
+
+        dist_X, self.neighbors_X = NearestNeighbors(n_neighbors=k).fit(X).kneighbors()
+        self.neighbors_Y = NearestNeighbors(n_neighbors=k).fit(Y).kneighbors(return_distance=False)
+
+        # S_q over all pairs, exact as in ExplainerContext; S_pj over the neighbourhoods of j in X
+        self.Q = None if Q is None or isinstance(Q, QMatrix) else Q
+        self.S_q = Q.sum_Q if isinstance(Q, QMatrix) else QMatrix.of_embedding(Y).sum_Q
+        self.S_pj = np.exp( -dist_X**2 / (2*(self.sigma**2)).reshape(n, 1) ).sum(axis=1)
+
+    def q(self, i, J, E_ij):
+        """
+        Function that returns the q-values between i and the points J, whose Student-t kernels are E_ij
+        """
+        if self.Q is None:
+            return E_ij / self.S_q
+        return _row(self.Q, i)[J]
+
+    def neighborhood(self, i):
+        """
+        Function that returns the union of the neighbourhoods of i in X and in Y
+        """
+        return np.union1d(self.neighbors_X[i], self.neighbors_Y[i])
+
+def compute_gradients_truncated(context, i):
+    """
+    Function that compute the saliency of instance i from its neighbourhood only.
+
+    The truncation error is estimated by adding a random sample of the points outside the neighbourhood,
+    weighted by the number of points it stands for, and propagating the change of the Hessian and of the
+    cross-derivative to first order through the linear solve.
+
+    Parameters:
+    -----------
+    context: TruncatedExplainerContext of the embedding
+    i: indice of the input to consider
+
+    Return:
+    -------
+    derivative: t-sne "saliency"
+    error: estimated relative (Frobenius) error of derivative against the exact compute_gradients, a noisy
+    estimate from tail_sample points that tells the usual size of the error over many instances (its median)
+    rather than which instances are the least accurate
+    """
+    n = context.X.shape[0]
+    J = context.neighborhood(i)
+
+    y2_derivative = _compute_y2_derivative_subset(i, J, np.ones(J.shape[0]), context)
+    yx_derivative = _compute_xy_derivative_subset(i, J, np.ones(J.shape[0]), context)
+    derivative = -np.linalg.solve(y2_derivative, yx_derivative.T)
+
+    outside = np.setdiff1d(np.arange(n), np.append(J, i), assume_unique=True)
+    if outside.shape[0] == 0 or context.tail_sample == 0:
+        return derivative, 0.0
+
+    T = context.rng.choice(outside, min(context.tail_sample, outside.shape[0]), replace=False)
+    w = np.full(T.shape[0], outside.shape[0] / T.shape[0])
+    delta_y2 = _compute_y2_derivative_subset(i, T, w, context)
+    delta_yx = _compute_xy_derivative_subset(i, T, w, context)
+    delta = -np.linalg.solve(y2_derivative, delta_yx.T + delta_y2 @ derivative)
+
+    error = np.linalg.norm(delta) / max(np.linalg.norm(derivative + delta), np.finfo('double').eps)
+
+    return derivative, error
+
+def compute_all_gradients_truncated(X, Y, P, Q, sigma, n_neighbors=100, tail_sample=128):
+    """
+    Function that compute the neighbourhood-truncated saliency of every instance (see compute_gradients_truncated)
+
+    Return:
+    -------
+    gradients: (n, m, d) t-sne "saliencies"
+    errors: (n,) estimated relative errors against the exact compute_gradients, noisy per instance
+    (see compute_gradients_truncated), their median following the median of the actual errors
+    """
+    context = TruncatedExplainerContext(X, Y, P, Q, sigma, n_neighbors, tail_sample)
+    n = X.shape[0]
+    gradients = np.empty((n, Y.shape[1], X.shape[1]))
+    errors = np.empty(n)
+
+    for i in range(n):
+        gradients[i], errors[i] = compute_gradients_truncated(context, i)
+
+    return gradients, errors
+
+def _compute_y2_derivative_subset(i, J, w, context):
+    """
+    Function that compute the terms of the second derivative regarding y_i (see _compute_y2_derivative)
+    coming from the points J, each counted w times. Q is recomputed from Y and the normalization S_q.
+    """
+    y = context.Y
+    m = y.shape[1]
+    S_q = context.S_q
+
+    d_ij = y[i] - y[J]
+    e_ij = 1 + np.sum(d_ij**2, axis=1)
+    E_ij = 1/e_ij
+
+    S_q_d = -4 * ((w * E_ij**2) @ d_ij)
+
+    v_ij = _row(context.P, i)[J] - context.q(i, J, E_ij)
+    v_ij_d = ( ( 2 * d_ij.T * E_ij**2 * S_q ) + ( S_q_d.reshape(m, 1) / e_ij ) ) / ( S_q**2 )
+
+    term1 = (v_ij_d * (w * E_ij)) @ d_ij
+    term2 = (2 * d_ij.T * (w * v_ij * E_ij**2)) @ d_ij
+    term3 = np.sum(w * v_ij * E_ij) * np.identity(m)
+
+    return 4 * ( term1 - term2 + term3 )
+
+def _compute_xy_derivative_subset(i, J, w, context):
+    """
+    Function that compute the terms of the second derivative regarding x_i (see _compute_xy_derivative)
+    coming from the points J, each counted w times
+    """
+    X = context.X
+    y = context.Y
+    n = X.shape[0]
+    sigma = context.sigma
+    neighbors = context.neighbors_X[i]
+
+    y_ij = y[i] - y[J]
+    x_ij = X[i] - X[J]
+    x_ji = -x_ij
+    E_ij = 1/(1 + np.sum(y_ij**2, axis=1))
+
+    dist_ij = np.sum(x_ij**2, axis=1)
+    exp_ij = np.exp( -( dist_ij / (2*(sigma[i]**2)) ) )
+    exp_ji = np.exp( -( dist_ij / (2*(sigma[J]**2)) ) )
+
+    # S_pi and its derivative come from the neighbourhood of i in X
+    x_in = X[i] - X[neighbors]
+    exp_in = np.exp( -( np.sum(x_in**2, axis=1) / (2*(sigma[i]**2)) ) )
+    S_pi = exp_in.sum()
+    S_pi_d = -(sigma[i]**(-2)) * (exp_in @ x_in)
+
+    S_pj = context.S_pj[J]
+    S_pj_d = (sigma[J]**(-2) * exp_ji).reshape(-1, 1) * x_ji
+
+    P_ji_d = ( ( -S_pi * x_ij * sigma[i]**(-2) * exp_ij.reshape(-1, 1)) - ( exp_ij.reshape(-1, 1) * S_pi_d ) ) / S_pi**2
+    P_ij_d = ( ( (S_pj * sigma[J]**(-2) * exp_ji).reshape(-1, 1) * x_ji ) - ( exp_ji.reshape(-1, 1) * S_pj_d ) ) / (S_pj**2).reshape(-1, 1)
+
+    v_ij_d = (1 / (2*n)) * (P_ji_d + P_ij_d)
+
+    return 4 * ( (w.reshape(-1, 1) * v_ij_d).T @ ( y_ij * E_ij.reshape(-1, 1) ) )
+
+def compute_transform_gradients(X, Y, X_new, Y_new, P_new, sigma_new, chunk_size=32):
+    """
+    Function that compute the saliency of points placed into an existing embedding by tsne.transform_tsne.
+
+    The embedding Y of the points X is fixed, so y_new only has to satisfy its own stationarity condition
+    sum_j (p_j|new - q_j|new) * E_j * (y_new - y_j) = 0, with q_j|new normalized over the row of the new point,
+    and the derivatives of this condition are formed in closed form, chunk_size new points at a time.
+
+    Parameters:
+    -----------
+    X: instances in high-dimensional space of the embedding
+    Y: embedding in low-dimensional space
+    X_new: new instances
+    Y_new, P_new, sigma_new: outputs of tsne.transform_tsne for X_new
+
+    Return:
+    -------
+    gradients: (len(X_new), m, d) t-sne "saliencies"
+    """
+    n_new = X_new.shape[0]
+    Y = np.asarray(Y, dtype=np.float64)
+    sigma_new = sigma_new.reshape((n_new,))
+    gradients = np.empty((n_new, Y.shape[1], X.shape[1]))
+
+    for start in range(0, n_new, chunk_size):
+        idx = np.arange(start, min(start + chunk_size, n_new))
+        gradients[idx] = _compute_transform_gradients_batch(X, Y, Y_new[idx], _rows(P_new, idx), sigma_new[idx])
+
+    return gradients
+
+def _compute_transform_gradients_batch(X, Y, y_new, p, sigma):
+    """
+    Function that compute the saliencies of a batch of new points (see compute_transform_gradients).
+    The P-rows are proportional to exp(-||x_new - x_j||^2 / sigma^2), as computed by tsne._x2p.
+    """
+    m = Y.shape[1]
+
+    d_ij = y_new[:, np.newaxis, :] - Y
+    E_ij = 1/(1 + np.sum(d_ij**2, axis=2))
+    S_q = E_ij.sum(axis=1)[:, np.newaxis, np.newaxis]
+
+    # Derivative regarding y_new of the attractive term sum_j p_j E_j d_j and of the repulsive term F / S_q,
+    # with F = sum_j E_j^2 d_j
+    pE = p * E_ij
+    attractive_d = pE.sum(axis=1)[:, np.newaxis, np.newaxis] * np.identity(m) - 2 * np.einsum('cn,cnk,cnl->ckl', pE * E_ij, d_ij, d_ij)
+    F = np.einsum('cn,cnm->cm', E_ij**2, d_ij)
+    F_d = (E_ij**2).sum(axis=1)[:, np.newaxis, np.newaxis] * np.identity(m) - 4 * np.einsum('cn,cnk,cnl->ckl', E_ij**3, d_ij, d_ij)
+    y2_derivative = attractive_d - ( F_d / S_q + 2 * F[:, :, np.newaxis] * F[:, np.newaxis, :] / S_q**2 )
+
+    # Derivative regarding x_new: dp_j/dx_new = -(2 / sigma^2) * p_j * (mu - x_j), where mu = sum_k p_k x_k
+    mu = p @ X
+    pEd = pE[:, :, np.newaxis] * d_ij
+    yx_derivative = -(2 / sigma**2)[:, np.newaxis, np.newaxis] * ( pEd.sum(axis=1)[:, :, np.newaxis] * mu[:, np.newaxis, :] - np.einsum('cnm,nd->cmd', pEd, X) )
+
+    return -np.linalg.solve(y2_derivative, yx_derivative)
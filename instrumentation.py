@@ -0,0 +1,209 @@
+import cProfile
+import io
+import logging
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+logger = logging.getLogger("insight_sne")
+
+
+class Observer:
+    """
+    Receiver of the instrumentation events of the t-SNE and of the explainer. Every event does nothing here,
+    subclasses override the ones they need.
+
+    Phases are the named steps of a computation ("distances", "calibration", "early exaggeration",
+    "optimization", "explainer context", "explanations"...); their info gives details such as the rows of a chunk.
+    """
+
+    def phase_start(self, phase, **info):
+        pass
+
+    def phase_end(self, phase, seconds, peak_memory = None, **info):
+        """seconds is the wall time of the phase, peak_memory the peak of the memory traced by tracemalloc
+        during the phase, in bytes, or None when tracemalloc is not tracing."""
+        pass
+
+    def iteration(self, iteration, cost):
+        pass
+
+    def message(self, text, level = logging.INFO):
+        pass
+
+    def profile(self, stats):
+        """Receives the pstats.Stats of a block run with capture(profile=True)."""
+        pass
+
+
+class LogObserver(Observer):
+    """Observer writing the events to the insight_sne logger, chunks of a phase at the DEBUG level only."""
+
+    def __init__(self, logger = logger, top = 20):
+        self.logger = logger
+        self.top = top
+
+    def phase_start(self, phase, **info):
+        self.logger.log(logging.DEBUG if "chunk" in info else logging.INFO, "%s%s...", phase, _format_info(info))
+
+    def phase_end(self, phase, seconds, peak_memory = None, **info):
+        memory = "" if peak_memory is None else ", peak memory %.1f MB" % (peak_memory / 2**20)
+        self.logger.log(logging.DEBUG if "chunk" in info else logging.INFO, "%s%s done in %.3f s%s",
+                        phase, _format_info(info), seconds, memory)
+
+    def iteration(self, iteration, cost):
+        self.logger.info("Iteration %d: error is %s", iteration, cost)
+
+    def message(self, text, level = logging.INFO):
+        self.logger.log(level, text)
+
+    def profile(self, stats):
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(self.top)
+        self.logger.info("Profile:\n%s", out.getvalue())
+
+
+class TimingObserver(Observer):
+    """Observer recording the total time, number and peak memory of every phase, and the iteration costs."""
+
+    def __init__(self):
+        self.phases = {}
+        self.costs = []
+        self._lock = threading.Lock()
+
+    def phase_end(self, phase, seconds, peak_memory = None, **info):
+        with self._lock:
+            record = self.phases.setdefault(phase, {"phase": phase, "seconds": 0.0, "count": 0, "peak_memory": None})
+            record["seconds"] += seconds
+            record["count"] += 1
+            if peak_memory is not None:
+                record["peak_memory"] = max(record["peak_memory"] or 0, peak_memory)
+
+    def iteration(self, iteration, cost):
+        self.costs.append((iteration, float(cost)))
+
+    def breakdown(self):
+        """List of the phases in the order they first ended, with their total seconds, count and peak memory."""
+        with self._lock:
+            return [dict(record) for record in self.phases.values()]
+
+
+class Observers(Observer):
+    """Observer forwarding every event to several observers."""
+
+    def __init__(self, *observers):
+        self.observers = [observer for observer in observers if observer is not None]
+
+    def phase_start(self, phase, **info):
+        for observer in self.observers:
+            observer.phase_start(phase, **info)
+
+    def phase_end(self, phase, seconds, peak_memory = None, **info):
+        for observer in self.observers:
+            observer.phase_end(phase, seconds, peak_memory, **info)
+
+    def iteration(self, iteration, cost):
+        for observer in self.observers:
+            observer.iteration(iteration, cost)
+
+    def message(self, text, level = logging.INFO):
+        for observer in self.observers:
+            observer.message(text, level)
+
+    def profile(self, stats):
+        for observer in self.observers:
+            observer.profile(stats)
+
+
+default_observer = LogObserver()
+
+_phases = threading.local()
+
+
+class Phase:
+    """
+    Times a phase of a computation and reports its start and end to an observer (default_observer when None),
+    either as a context manager or with explicit start() and end() calls. While tracemalloc is tracing,
+    the peak memory of the phase is reported too, nested phases included.
+    """
+
+    def __init__(self, observer, phase, **info):
+        self.observer = observer if observer is not None else default_observer
+        self.phase = phase
+        self.info = info
+        self.started = None
+
+    def start(self):
+        self.observer.phase_start(self.phase, **self.info)
+        self.peak = 0
+        if tracemalloc.is_tracing():
+            self._propagate_peak()
+            tracemalloc.reset_peak()
+        _stack().append(self)
+        self.started = time.perf_counter()
+        return self
+
+    def end(self):
+        if self.started is None:
+            return
+        seconds = time.perf_counter() - self.started
+        self.started = None
+        peak_memory = None
+        stack = _stack()
+        if self in stack:
+            stack.remove(self)
+        if tracemalloc.is_tracing():
+            peak_memory = max(self.peak, tracemalloc.get_traced_memory()[1])
+            for phase in stack:
+                phase.peak = max(phase.peak, peak_memory)
+        self.observer.phase_end(self.phase, seconds, peak_memory, **self.info)
+
+    def _propagate_peak(self):
+        # The peak is reset for this phase, so the enclosing phases keep the one reached so far
+        peak = tracemalloc.get_traced_memory()[1]
+        for phase in _stack():
+            phase.peak = max(phase.peak, peak)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.end()
+
+
+def _stack():
+    if not hasattr(_phases, "stack"):
+        _phases.stack = []
+    return _phases.stack
+
+
+def _format_info(info):
+    if not info:
+        return ""
+    return " (" + ", ".join("%s %s" % (key, value) for key, value in info.items()) + ")"
+
+
+@contextmanager
+def capture(observer = None, profile = True, memory = True):
+    """
+    Runs the block under cProfile, handing the pstats.Stats to observer.profile at the end, and/or
+    with tracemalloc tracing, so that the phases of the block report their peak memory.
+    """
+    observer = observer if observer is not None else default_observer
+    started_tracing = memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    profiler = cProfile.Profile() if profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            observer.profile(pstats.Stats(profiler))
+        if started_tracing:
+            tracemalloc.stop()
@@ -1,20 +1,29 @@
 import json
+import uuid
 
 import dash
 import dash_bootstrap_components as dbc
-import numpy as np
-import pandas as pd
 from dash import dcc, html
 from dash.dependencies import Input, Output, State
-from sklearn import datasets, preprocessing
+from dash.exceptions import PreventUpdate
 
-from explainer import compute_all_gradients
+from cache import cached_tsne, job_cache, result_cache, run_store
+from dataset_registry import dataset_registry
+from instrumentation import Observers, TimingObserver, capture, default_observer
 from plots import create_plot_tsne_embedding
-from tsne import compute_tsne
+from resources import compute_resources
+
+# Runs the t-SNE under cProfile, logging the profile, and tracemalloc, so that the run timings include peak memory
+PROFILE_RUNS = False
+
+# Runs whose exact t-SNE would need more than this for its NxN buffers (about 6 of them) compute them by blocks
+# within this budget instead, keeping P as the only NxN array, spilled to a temporary file when it does not fit
+MEMORY_BUDGET = 1024 * 2**20
 
 
 def layout():
     return html.Div([
+        dcc.Store(id='tsne-job-token', data=uuid.uuid4().hex),
         tsne_param_component()
     ], className="d-flex justify-content-center")
 
@@ -30,16 +39,18 @@ def tsne_param_component():
                             dbc.Label("Dataset", className="input-label"),
                             dcc.Dropdown(
                                 id='dataset-dropdown',
-                                options=[
-                                    {'label': 'Iris', 'value': 'iris'},
-                                    {'label': 'Diabetes', 'value': 'diabetes'},
-                                    {'label': 'Countries', 'value': 'countries'},
-                                    {'label': 'Zoo', 'value': 'zoo'}
-                                ],
+                                options=dataset_registry.options(),
                                 value='iris',
                                 multi=False,
                                 className=""
                             ),
+                            dcc.Upload(
+                                id='dataset-upload',
+                                children=html.Div(["Drop or ", html.A("select a CSV file")]),
+                                accept=".csv",
+                                className="dataset-upload mt-2"
+                            ),
+                            html.Div(id='dataset-upload-status', className="dataset-upload-status"),
                         ],
                         className="",
                     ),
@@ -67,6 +78,14 @@ def tsne_param_component():
                         [
                             dbc.Button('Visualize', id='run-tsne-button',
                                        n_clicks=0, color='primary', className="w-100"),
+                            dbc.Progress(id='tsne-progress', value=0, label="", striped=True, animated=True,
+                                         className="mt-3", style={'visibility': 'hidden'}),
+                            dcc.Graph(id='tsne-preview', config={'staticPlot': True}, figure={},
+                                      style={'display': 'none', 'height': '250px'}),
+                            dbc.Button('Stop & view', id='stop-tsne-button', n_clicks=0, disabled=True,
+                                       color='primary', outline=True, size="sm", className="w-100 mt-2"),
+                            dbc.Button('Cancel', id='cancel-tsne-button', n_clicks=0, disabled=True,
+                                       color='secondary', outline=True, size="sm", className="w-100 mt-2"),
                         ],
                         className="mt-3"
                     )
@@ -76,58 +95,115 @@ def tsne_param_component():
     )
 
 
-def run_tsne(selected_datasets, perplexity, max_iter):
-    def prepare_data(selected_dataset):
-
-        if selected_dataset == 'iris':
-            iris = datasets.load_iris()
-            return iris.data, iris.target, iris.feature_names, 3
-        elif selected_dataset == 'diabetes': 
-            diabetes = datasets.load_diabetes()
-            return diabetes.data, diabetes.target, diabetes.feature_names, 1
-        elif selected_dataset == 'countries':
-            countries = pd.read_csv("datasets/country_dataset_with_names.csv", index_col = 0)
-            X = countries.to_numpy()[0:].astype(np.float64)
-            scaler = preprocessing.StandardScaler()
-            X = scaler.fit_transform(X)
-            countries_names = countries.index.to_numpy()
-            feature_names = countries.columns.tolist()
-            return X, countries_names, feature_names, 1
-        elif selected_dataset == 'zoo':
-            zoo = pd.read_csv("datasets/zoo.csv", index_col = 0)
-            del zoo['class_type']
-            X = zoo.to_numpy()[0:].astype(np.float64)
-            animal_names = zoo.index.to_numpy()
-            feature_names = zoo.columns.tolist()
-            return X, animal_names, feature_names, 1
-
+def run_tsne(selected_datasets, perplexity, max_iter, set_progress=None, job_token=None):
     if len(selected_datasets) == 0:
         return json.dumps({})
 
-    X, targets, feature_names, nb_classes = prepare_data(selected_datasets)
+    # The dataset is converted once into memory-mapped arrays, then loaded in constant time
+    dataset = dataset_registry.load(selected_datasets)
+    if dataset is None:
+        return json.dumps({})
+    X, targets, feature_names, nb_classes = dataset['X'], dataset['labels'], dataset['feature_names'], dataset['nb_classes']
     
-    Y, P, Q, sigma = compute_tsne(X, no_dims=2, perplexity=perplexity, max_iter=max_iter)
+    # The P-values take the first 20% of the progress bar, the iterations the rest, reported with
+    # a preview of the embedding every few iterations
+    reported = [-1]
+    def progress(phase, done, total):
+        percent = int(20 * done / total)
+        if set_progress is not None and phase == "P-values" and percent != reported[0]:
+            reported[0] = percent
+            set_progress((percent, "Computing P-values...", {}))
+
+    def snapshot(iteration, Y, cost):
+        # The threads are split again between the jobs running at this point
+        compute_resources.refresh(job_id)
+        if set_progress is not None:
+            set_progress((int(20 + 80 * iteration / max_iter), f"Iteration {iteration} of {max_iter}, error {cost:.3f}",
+                          create_plot_tsne_embedding(X, Y, targets, selected_datasets)))
+        return job_token is not None and job_cache.get(f"stop-{job_token}", False)
+
+    if job_token is not None:
+        job_cache.delete(f"stop-{job_token}")
+
+    timing = TimingObserver()
+    observer = Observers(timing, default_observer)
+    blocked = {"memory_budget": MEMORY_BUDGET, "memmap_file": "auto"} if 6 * 8 * X.shape[0]**2 > MEMORY_BUDGET else {}
+
+    # max_iter is an upper bound, the optimization stops as soon as the error has settled
+    with capture(observer, profile=PROFILE_RUNS, memory=PROFILE_RUNS), compute_resources.job(f"t-SNE {selected_datasets}") as job_id:
+        run_id, Y, P, Q, sigma, n_iter, timings = cached_tsne(result_cache, X, seed=0, progress=progress, snapshot=snapshot,
+                                                              snapshot_every=25, observer=observer, no_dims=2,
+                                                              perplexity=perplexity, max_iter=max_iter,
+                                                              learning_rate="auto", exaggeration_iter="auto",
+                                                              min_grad_norm=1e-7, kl_tol=1e-3, n_iter_check=50,
+                                                              **blocked)
+
+    # The t-SNE phases are those of the run that filled the cache, the other ones those of this call
+    computed = {t["phase"] for t in timings}
+    timings = timings + [t for t in timing.breakdown() if t["phase"] not in computed]
+    run_store.save_run(run_id, X, Y, targets, feature_names, nb_classes, selected_datasets, n_iter=n_iter,
+                       timings=timings)
+
+    return json.dumps({'run_id': run_id})
 
-    gradients = compute_all_gradients(X, Y, P, Q, sigma)
-
-    return json.dumps({'nb_classes': nb_classes, 'X': X.tolist(), 'labels': targets.tolist(), 'feature_names': feature_names,
-                       'embedding': Y.tolist(), 'gradients': gradients.tolist(), 'dataset_name': selected_datasets})
+@dash.callback(
+    Output('tsne-data', 'data'),
+    [Input('run-tsne-button', 'n_clicks')]
+)
+def reset_tsne_data(n_clicks):
+    # The page load clears the previous run here, so that it does not start a background job
+    if n_clicks == 0:
+        return json.dumps({})
+    raise PreventUpdate
 
 @dash.callback(
     Output('url', 'pathname'),
-    Output('tsne-data', 'data'),
+    Output('tsne-data', 'data', allow_duplicate=True),
     [Input('run-tsne-button', 'n_clicks')],
-    [State('url', 'pathname')],
     [State('dataset-dropdown', 'value')],
     [State('perplexity-input', 'value')],
-    [State('max-iterations-input', 'value')]
+    [State('max-iterations-input', 'value')],
+    [State('tsne-job-token', 'data')],
+    background=True,
+    progress=[Output('tsne-progress', 'value'), Output('tsne-progress', 'label'), Output('tsne-preview', 'figure')],
+    running=[(Output('run-tsne-button', 'disabled'), True, False),
+             (Output('cancel-tsne-button', 'disabled'), False, True),
+             (Output('stop-tsne-button', 'disabled'), False, True),
+             (Output('tsne-progress', 'style'), {'visibility': 'visible'}, {'visibility': 'hidden'}),
+             (Output('tsne-preview', 'style'), {'display': 'block', 'height': '250px'}, {'display': 'none'})],
+    cancel=[Input('cancel-tsne-button', 'n_clicks')],
+    prevent_initial_call=True
+)
+def navigate(set_progress, n_clicks, selected_datasets, perplexity, max_iter, job_token):
+    return 'dashboard', run_tsne(selected_datasets, perplexity, max_iter, set_progress, job_token)
 
+
+@dash.callback(
+    Output('dataset-dropdown', 'options'),
+    Output('dataset-dropdown', 'value'),
+    Output('dataset-upload-status', 'children'),
+    [Input('dataset-upload', 'contents')],
+    [State('dataset-upload', 'filename')],
+    prevent_initial_call=True
+)
+def upload_dataset(contents, filename):
+    try:
+        name = dataset_registry.upload(filename, contents)
+    except (ValueError, UnicodeDecodeError) as e:
+        return dash.no_update, dash.no_update, f"Could not read {filename}: {e}"
+    return dataset_registry.options(), name, f"{filename} added"
+
+
+@dash.callback(
+    Output('stop-tsne-button', 'children'),
+    [Input('stop-tsne-button', 'n_clicks')],
+    [State('tsne-job-token', 'data')],
+    prevent_initial_call=True
 )
-def navigate(n_clicks, current_url, selected_datasets, perplexity, max_iter):
-    if n_clicks > 0:
-        return 'dashboard', run_tsne(selected_datasets, perplexity, max_iter)
-    else:
-        return current_url, json.dumps({})
+def stop_tsne(n_clicks, job_token):
+    # The running job polls this flag at its next snapshot and returns the current embedding
+    job_cache.set(f"stop-{job_token}", True, expire=3600)
+    return "Stopping..."
 
 
 dash.register_page(__name__, path='/')
@@ -1,16 +1,24 @@
 import json
 
 import dash
-import numpy as np
+import dash_bootstrap_components as dbc
 import plotly.graph_objects as go
-from dash import dcc, html
+from dash import Patch, dcc, html
 from dash.dependencies import Input, Output, State
 
+from dash.exceptions import PreventUpdate
+
+from cache import result_cache, run_store
 from css_colors_exposed import Color
+from explainer import ExplanationProvider, get_provider, register_provider
 from plots import (create_average_feature_distribution_plot,
                    create_combined_gradients_plot,
+                   compute_feature_grids,
+                   create_feature_contour_trace,
                    create_feature_importance_ranking_plot,
+                   create_gradient_arrows_trace,
                    create_plot_tsne_embedding)
+from resources import compute_resources
 
 
 def overview_card():
@@ -47,6 +55,13 @@ def feature_distribution_plot():
                      className="feature-distribution-plot")
 
 
+def run_timings_card():
+    return html.Details([
+        html.Summary("Run Timings", className="section-title"),
+        html.Div(id='run-timings')
+    ], className="run-timings mt-4")
+
+
 def layout():
     return html.Div([
         html.Div([
@@ -55,7 +70,8 @@ def layout():
                 overview_card(),
             ]),
             html.Div("Global Average Feature Distribution", id="feature-distribution-plot-title", className="section-title mt-4"),
-            feature_distribution_plot()
+            feature_distribution_plot(),
+            run_timings_card()
         ], className="sub-container-1"),
         html.Div([
             scatter_plot_card()
@@ -67,170 +83,170 @@ def layout():
     ], className="main-container")
 
 
+def load_run(tsne_data):
+    """Returns the server-side data of the run referenced by the session store."""
+    run = run_store.load_run(json.loads(tsne_data).get('run_id'))
+    if run is None:
+        raise PreventUpdate
+    return run
+
+
+def load_provider(tsne_data, run):
+    """Returns the explanation provider of the run, rebuilding it from the result cache if needed."""
+    run_id = json.loads(tsne_data).get('run_id')
+    provider = get_provider(run_id)
+    if provider is None:
+        arrays = result_cache.get(run_id)
+        if arrays is None:
+            raise PreventUpdate
+        provider = ExplanationProvider(run['X'], arrays['Y'], arrays['P'], arrays['Q'], arrays['sigma'], run_id=run_id,
+                                       resources=compute_resources, cache=result_cache)
+        register_provider(provider)
+    return provider
+
+
+def load_feature_grid(tsne_data, run, feature_id):
+    """Returns the grid coordinates and the interpolated values of a feature over the embedding of the run,
+    interpolating all the features once and adding them to the run store on first use."""
+    if 'feature_grids' not in run:
+        grid_x, grid_y, grids = compute_feature_grids(run['X'], run['embedding'])
+        run_store.put(json.loads(tsne_data).get('run_id'), grid_x=grid_x, grid_y=grid_y, feature_grids=grids)
+        run.update(grid_x=grid_x, grid_y=grid_y, feature_grids=grids)
+    return run['grid_x'], run['grid_y'], run['feature_grids'][feature_id]
+
+
+def overlay_traces(contour = None, arrows = None):
+    """The contour plot and gradient arrows drawn after the scatter traces, or hidden placeholders for them."""
+    if contour is None:
+        contour = go.Contour(name="feature-contour", visible=False)
+    if arrows is None:
+        arrows = go.Scattergl(x=[], y=[], mode="lines", name="gradient-arrows", visible=False)
+    return [contour, arrows]
+
+
+def timings_table(timings, n_iter = None):
+    """Table of the time, count and peak memory of the phases of a run (see instrumentation.TimingObserver)."""
+    rows = [html.Tr([html.Td(t['phase']),
+                     html.Td(f"{t['seconds']:.3f} s"),
+                     html.Td(t['count']),
+                     html.Td("-" if t['peak_memory'] is None else f"{t['peak_memory'] / 2**20:.1f} MB")])
+            for t in timings]
+    header = html.Thead(html.Tr([html.Th("Phase"), html.Th("Time"), html.Th("Count"), html.Th("Peak memory")]))
+    caption = [] if n_iter is None else [html.Div(f"{n_iter} iterations")]
+    return caption + [dbc.Table([header, html.Tbody(rows)], size="sm", borderless=True)]
+
+
+def selected_indices(selected_data, n):
+    """Indices of the points selected in the scatter plot, all of them when there is no selection."""
+    if selected_data is None:
+        return list(range(n))
+    if selected_data['points'] == []:
+        if 'lassoPoints' in selected_data:
+            return []
+        return list(range(n))
+    return [point['customdata'][0] for point in selected_data['points']]
+
+
 @dash.callback(
     Output('tsne-plot', 'figure'),
     [Input('tsne-data', 'data'),
      Input('explanation-barplot', 'clickData'),
      Input('tsne-plot', 'selectedData')],
-    [State('tsne-plot', 'figure'),
-     State('explanation-barplot', 'figure')]
+    [State('explanation-barplot', 'figure')]
 )
-def update_scatter_plot(tsne_data, click_data, selected_data, tsne_figure, explanation_figure): # TODO: CAN'T HOVER ON SELECTED DATA
+def update_scatter_plot(tsne_data, click_data, selected_data, explanation_figure): # TODO: CAN'T HOVER ON SELECTED DATA
     ctx = dash.callback_context
     triggered_component_id = ctx.triggered[0]['prop_id'].split('.')[0]
 
-    tsne_data = json.loads(tsne_data)
-    Y = np.array(tsne_data.get('embedding'))
-    X = np.array(tsne_data.get('X'))
+    run = load_run(tsne_data)
+    Y = run['embedding']
+    X = run['X']
 
-    fig = tsne_figure
-    
-    if fig is None:
-        targets = np.array(tsne_data.get('labels'))
-        dataset_name = tsne_data.get('dataset_name')
-        return create_plot_tsne_embedding(X, Y, targets, dataset_name)
-    else:
-        fig = go.Figure(tsne_figure)
-        shapes = []
-        nb_classes = tsne_data.get('nb_classes')
-
-        if len(fig["data"]) == nb_classes+1:
-            new_data = list(fig["data"])
-            new_data.pop(nb_classes) # remove contour plot
-            fig["data"] = new_data
-
-        if triggered_component_id == 'explanation-barplot':
-           
-            if explanation_figure['data'][0]['marker']['color'][click_data['points'][0]['pointIndex']] == Color.primary.value: 
-                fig['layout']['shapes'] = shapes
-                return fig
-            else:
-                selected_points = []
-                for i in range(len(fig['data'])):
-                    if fig['data'][i]['selectedpoints'] is not None:
-                        point_idx = fig['data'][i]['selectedpoints']
-                        selected_points += [fig['data'][i]['customdata'][point_id][0] for point_id in point_idx]
-                    else:
-                        selected_points += [j[0] for j in fig['data'][i]['customdata']]
-
-                coordinates = Y[selected_points]
-                gradients = np.array(tsne_data.get('gradients'))
-
-                feature_id = click_data['points'][0]['pointIndex']
-
-                for i in range(coordinates.shape[0]):
-                    point_id = selected_points[i]
-                    x0, y0 = coordinates[i]
-                    x1, y1 = coordinates[i] + gradients[point_id, :, feature_id]*1 # TODO: DETERMINE SCALING FACTOR
-                      
-                    shapes.append({
-                        'type': 'line',
-                        'x0': x0,
-                        'x1': x1,
-                        'y0': y0,
-                        'y1': y1,
-                        'line': {
-                            'color': Color.success.value,
-                            'width': 2
-                        },
-                        'opacity': 0.8
-                    })
-
-                fig['layout']["shapes"] = shapes
-                fig.add_trace(go.Contour(x=Y[:,0],y=Y[:,1],z=np.array(X[:, feature_id]), hoverinfo='skip', colorscale='Pinkyl', line = dict(width = 0)))
-
-                return fig
-        elif triggered_component_id == 'tsne-plot':
-            
-            if Color.primary.value not in explanation_figure['data'][0]['marker']['color']: # no selected feature
-                fig['layout']['shapes'] = shapes
-                return fig
-            else:
-                feature_id = explanation_figure['data'][0]['marker']['color'].index(Color.primary.value)
-
-                if selected_data is not None:
-                    if selected_data['points'] == []:
-                        if 'lassoPoints' in selected_data:
-                            fig['layout']['shapes'] = shapes
-                            fig.add_trace(go.Contour(x=Y[:,0],y=Y[:,1],z=np.array(X[:, feature_id]), hoverinfo='skip', colorscale='Pinkyl', line = dict(width = 0)))
-                            return fig
-                        else:
-                            selected_points = [i for i in range(len(Y))]
-                    else:
-                        selected_points = [selected_data['points'][i]['customdata'][0] for i in range(len(selected_data['points']))]
-                    
-                    coordinates = Y[selected_points]
-                    gradients = np.array(tsne_data.get('gradients'))
-
-                    for i in range(coordinates.shape[0]):
-                        point_id = selected_points[i]
-                        x0, y0 = coordinates[i]
-                        x1, y1 = coordinates[i] + gradients[point_id, :, feature_id]*1 # TODO: DETERMINE SCALING FACTOR
-                        shapes.append({
-                            'type': 'line',
-                            'x0': x0,
-                            'x1': x1,
-                            'y0': y0,
-                            'y1': y1,
-                            'line': {
-                                'color': Color.success.value,
-                                'width': 2
-                            },
-                            'opacity': 0.8
-                        })
-
-                    fig['layout']["shapes"] = shapes
-                fig.add_trace(go.Contour(x=Y[:,0],y=Y[:,1],z=np.array(X[:, feature_id]), hoverinfo='skip', colorscale='Pinkyl', line = dict(width = 0)))
-
-                return fig
-        else:
-            return fig
+    if triggered_component_id not in ('explanation-barplot', 'tsne-plot'):
+        targets = run['labels']
+        dataset_name = run['dataset_name']
+        fig = create_plot_tsne_embedding(X, Y, targets, dataset_name)
+        fig.add_traces(overlay_traces())
+        return fig
+
+    # Only the overlays, which follow the scatter traces, are sent back
+    nb_classes = run['nb_classes']
+    patch = Patch()
+    contour, arrows = overlay_traces()
+
+    if triggered_component_id == 'explanation-barplot':
+        feature_id = click_data['points'][0]['pointIndex']
+
+        if explanation_figure['data'][0]['marker']['color'][feature_id] != Color.primary.value:
+            selected_points = selected_indices(selected_data, len(Y))
+            gradients = load_provider(tsne_data, run).gradients(selected_points)
+
+            contour = create_feature_contour_trace(*load_feature_grid(tsne_data, run, feature_id))
+            arrows = create_gradient_arrows_trace(Y[selected_points], gradients[:, :, feature_id])
+
+    elif Color.primary.value in explanation_figure['data'][0]['marker']['color']:
+        feature_id = explanation_figure['data'][0]['marker']['color'].index(Color.primary.value)
+        contour = create_feature_contour_trace(*load_feature_grid(tsne_data, run, feature_id))
+
+        if selected_data is not None:
+            selected_points = selected_indices(selected_data, len(Y))
+            gradients = load_provider(tsne_data, run).gradients(selected_points)
+            arrows = create_gradient_arrows_trace(Y[selected_points], gradients[:, :, feature_id])
+
+    patch['data'][nb_classes] = contour.to_plotly_json()
+    patch['data'][nb_classes + 1] = arrows.to_plotly_json()
+    return patch
 
 
 @dash.callback(
     Output('overview-plot', 'figure'),
-    [State('overview-plot', 'figure')],
-    [Input('tsne-plot', 'relayoutData'),
-    Input('tsne-plot', 'figure')],
-    prevent_initial_call=True
+    [Input('tsne-data', 'data'),
+     Input('tsne-plot', 'relayoutData')]
 )
-def update_overview_plot(overview_plot, relayout_data, tsne_plot):
-    if overview_plot is not None:
-        fig = overview_plot
-    else:
-        fig = tsne_plot
+def update_overview_plot(tsne_data, relayout_data):
+    ctx = dash.callback_context
+    triggered_component_id = ctx.triggered[0]['prop_id'].split('.')[0]
 
-    if relayout_data is not None:
-        layout = fig['layout']
-        shapes = layout.get('shapes', [])
+    if triggered_component_id != 'tsne-plot':
+        run = load_run(tsne_data)
+        return create_plot_tsne_embedding(run['X'], run['embedding'], run['labels'], run['dataset_name'])
 
-        if 'xaxis.autorange' in relayout_data or 'xaxis.range[0]' in relayout_data:
-            shapes = []
+    if relayout_data is None or not ('xaxis.autorange' in relayout_data or 'xaxis.range[0]' in relayout_data):
+        return dash.no_update
 
-        if 'xaxis.range[0]' in relayout_data:
+    # Only the rectangle of the zoomed area is sent back
+    shapes = []
+    if 'xaxis.range[0]' in relayout_data:
 
-            x0 = relayout_data['xaxis.range[0]']
-            x1 = relayout_data['xaxis.range[1]']
-            y0 = relayout_data['yaxis.range[0]']
-            y1 = relayout_data['yaxis.range[1]']
+        x0 = relayout_data['xaxis.range[0]']
+        x1 = relayout_data['xaxis.range[1]']
+        y0 = relayout_data['yaxis.range[0]']
+        y1 = relayout_data['yaxis.range[1]']
 
-            shapes.append({
-                'type': 'rect',
-                'x0': x0,
-                'x1': x1,
-                'y0': y0,
-                'y1': y1,
-                'line': {
-                    'color': Color.info.value,
-                    'width': 2
-                }
-            })
+        shapes.append({
+            'type': 'rect',
+            'x0': x0,
+            'x1': x1,
+            'y0': y0,
+            'y1': y1,
+            'line': {
+                'color': Color.info.value,
+                'width': 2
+            }
+        })
 
-          
-        layout['shapes'] = shapes
-        fig['layout'] = layout
+    patch = Patch()
+    patch['layout']['shapes'] = shapes
+    return patch
 
-    return fig
+
+@dash.callback(
+    Output('run-timings', 'children'),
+    Input('tsne-data', 'data')
+)
+def update_run_timings(tsne_data):
+    run = load_run(tsne_data)
+    return timings_table(run.get('timings') or [], run.get('n_iter'))
 
 
 @dash.callback(
@@ -238,19 +254,17 @@ def update_overview_plot(overview_plot, relayout_data, tsne_plot):
     Output('explanation-barplot-title', 'children'),
     [Input('tsne-data', 'data'),
      Input('tsne-plot', 'selectedData'),
-     Input('explanation-barplot', 'clickData'),
      State('explanation-barplot', 'figure'),
      State('explanation-barplot-title', 'children'),]
 )
-def update_explanation_bar_plot(tsne_data, selected_data, click_data, figure, title):
+def update_explanation_bar_plot(tsne_data, selected_data, figure, title):
     ctx = dash.callback_context
     triggered_component_id = ctx.triggered[0]['prop_id'].split('.')[0]
 
     
-    gradients_data = json.loads(tsne_data)
-    gradients = gradients_data.get('gradients')
-    feature_names = gradients_data.get('feature_names')
-    gradients = np.array(gradients)
+    run = load_run(tsne_data)
+    provider = load_provider(tsne_data, run)
+    feature_names = run['feature_names']
     fig = figure
     title=title
 
@@ -259,94 +273,128 @@ def update_explanation_bar_plot(tsne_data, selected_data, click_data, figure, ti
             selected_indices = [point['customdata'][0]
                                 for point in selected_data['points']]
             colors = fig['data'][0]['marker']['color']
-            fig = create_combined_gradients_plot(gradients, feature_names, selected_indices[0])
+            fig = create_combined_gradients_plot(provider.gradients(selected_indices[:1]), feature_names, 0)
             
             fig.update_traces(marker=dict(color = colors))
             title = "Feature Importance for Selected Points"
         else:
             colors = fig['data'][0]['marker']['color']
-            fig = create_feature_importance_ranking_plot(gradients, feature_names)
+            fig = create_feature_importance_ranking_plot(None, feature_names, provider.feature_importance())
             fig.update_traces(marker=dict(color = colors))
             title = "Global Feature Importance"
-    elif triggered_component_id == 'explanation-barplot':
-        fig = go.Figure(figure)
-
-        colors = [Color.primaryBorderSubtle.value for i in range(len(fig.data[0]['x']))]
-        feature_id = click_data['points'][0]['pointIndex'] 
-        
-        if fig['data'][0]['marker']['color'][feature_id] != Color.primary.value:
-            colors[feature_id] = Color.primary.value
-        
-        fig.update_traces(marker=dict(color = colors))
     else:
-        fig = create_feature_importance_ranking_plot(gradients, feature_names)
+        fig = create_feature_importance_ranking_plot(None, feature_names, provider.feature_importance())
         title = "Global Feature Importance"
     
     return fig, title
 
 
+# Clicking a bar only toggles its highlight, which is done in the browser
+dash.clientside_callback(
+    """
+    function(click_data, figure) {
+        const primary = %(primary)s, subtle = %(subtle)s;
+        if (!click_data || !figure) {
+            return window.dash_clientside.no_update;
+        }
+        const feature_id = click_data.points[0].pointIndex;
+        const trace = figure.data[0];
+        const colors = trace.y.map(() => subtle);
+        if (trace.marker.color[feature_id] !== primary) {
+            colors[feature_id] = primary;
+        }
+        const data = figure.data.slice();
+        data[0] = {...trace, marker: {...trace.marker, color: colors}};
+        return {...figure, data: data};
+    }
+    """ % {'primary': json.dumps(Color.primary.value), 'subtle': json.dumps(Color.primaryBorderSubtle.value)},
+    Output('explanation-barplot', 'figure', allow_duplicate=True),
+    Input('explanation-barplot', 'clickData'),
+    State('explanation-barplot', 'figure'),
+    prevent_initial_call=True
+)
+
+
 @dash.callback(
     Output('feature-distribution-plot', 'figure'),
     Output('feature-distribution-plot-title', 'children'),
     [Input('tsne-data', 'data'),
-     Input('tsne-plot', 'selectedData'),
-     Input('explanation-barplot', 'hoverData'),
-     Input('explanation-barplot', 'clickData')],
+     Input('tsne-plot', 'selectedData')],
     [State('feature-distribution-plot', 'figure'),
      State('feature-distribution-plot-title', 'children')]
 )
-def update_feature_distribution_plot(tsne_data, selected_data, hover_data, click_data, figure, title):
+def update_feature_distribution_plot(tsne_data, selected_data, figure, title):
 
     ctx = dash.callback_context
-    triggered_component_id, triggered_event = ctx.triggered[0]['prop_id'].split('.')
+    triggered_component_id = ctx.triggered[0]['prop_id'].split('.')[0]
     title = title
-    if triggered_component_id == 'explanation-barplot':
-        fig = go.Figure(figure)
-        colors = [Color.primaryBorderSubtle.value for i in range(len(fig.data[0]['x']))]
-        line_colors = [Color.primaryBorderSubtle.value for i in range(len(fig.data[0]['x']))]
-        if triggered_event == 'hoverData':
-            
-            colors = fig['data'][0]['marker']['color']
-            if Color.primary.value in colors:
-                line_colors[colors.index(Color.primary.value)] = Color.primary.value
-            if hover_data is not None:
-                feature_id = hover_data['points'][0]['pointIndex'] 
-                line_colors[feature_id] = Color.primary.value
-
-                    
 
+    run = load_run(tsne_data)
+    X = run['X']
+    feature_names = run['feature_names']
 
-        elif triggered_event == 'clickData':
-            feature_id = click_data['points'][0]['pointIndex'] 
-            if fig['data'][0]['marker']['color'][feature_id] != Color.primary.value:
-                colors[feature_id] = Color.primary.value
-            line_colors[feature_id] = Color.primary.value
-            
-        
-        fig.update_traces(marker=dict(color = colors, line=dict(color=line_colors, width=3)))
+    selected_indices = [i for i in range(X.shape[0])]
 
-    else:
-        data = json.loads(tsne_data)
-        X = data.get('X')
-        feature_names = data.get('feature_names')
-        X = np.array(X)
-
-        selected_indices = [i for i in range(X.shape[0])]
-
-        if triggered_component_id == 'tsne-plot' or triggered_component_id == 'explanation-barplot':
-            if selected_data is not None and selected_data['points'] != []:
-                title = "Average Feature Distribution for Selected Points"
-                selected_indices = [point['customdata'][0]
-                                    for point in selected_data['points']]
-            else:
-                title = "Global Average Feature Distribution"
-        
-        fig  = create_average_feature_distribution_plot(feature_names, X, selected_indices)
-        
-        if figure is not None:
-            fig.update_traces(marker=figure['data'][0]['marker'])
+    if triggered_component_id == 'tsne-plot':
+        if selected_data is not None and selected_data['points'] != []:
+            title = "Average Feature Distribution for Selected Points"
+            selected_indices = [point['customdata'][0]
+                                for point in selected_data['points']]
+        else:
+            title = "Global Average Feature Distribution"
+    
+    fig  = create_average_feature_distribution_plot(feature_names, X, selected_indices)
+    
+    if figure is not None:
+        fig.update_traces(marker=figure['data'][0]['marker'])
        
     return fig, title
 
 
+# Hovering and clicking the bars of the explanation only restyle the distribution plot, in the browser:
+# the clicked feature is filled, the clicked and hovered features are outlined
+dash.clientside_callback(
+    """
+    function(hover_data, click_data, figure) {
+        const primary = %(primary)s, subtle = %(subtle)s;
+        if (!figure) {
+            return window.dash_clientside.no_update;
+        }
+        const trace = figure.data[0];
+        let colors = trace.y.map(() => subtle);
+        const line_colors = trace.y.map(() => subtle);
+        const triggered = window.dash_clientside.callback_context.triggered.map(t => t.prop_id);
+
+        if (triggered.includes('explanation-barplot.hoverData')) {
+            colors = trace.marker.color;
+            const selected = colors.indexOf(primary);
+            if (selected !== -1) {
+                line_colors[selected] = primary;
+            }
+            if (hover_data) {
+                line_colors[hover_data.points[0].pointIndex] = primary;
+            }
+        } else if (click_data) {
+            const feature_id = click_data.points[0].pointIndex;
+            if (trace.marker.color[feature_id] !== primary) {
+                colors[feature_id] = primary;
+            }
+            line_colors[feature_id] = primary;
+        } else {
+            return window.dash_clientside.no_update;
+        }
+
+        const data = figure.data.slice();
+        data[0] = {...trace, marker: {...trace.marker, color: colors, line: {...trace.marker.line, color: line_colors, width: 3}}};
+        return {...figure, data: data};
+    }
+    """ % {'primary': json.dumps(Color.primary.value), 'subtle': json.dumps(Color.primaryBorderSubtle.value)},
+    Output('feature-distribution-plot', 'figure', allow_duplicate=True),
+    Input('explanation-barplot', 'hoverData'),
+    Input('explanation-barplot', 'clickData'),
+    State('feature-distribution-plot', 'figure'),
+    prevent_initial_call=True
+)
+
+
 dash.register_page(__name__)
@@ -4,6 +4,7 @@ import pandas as pd
 import plotly.express as px
 import plotly.figure_factory as ff
 import plotly.graph_objects as go
+from scipy.interpolate import griddata
 
 from css_colors_exposed import Color
 
@@ -51,20 +52,24 @@ def create_plot_tsne_embedding(X, Y, targets, dataset_name):
     if dataset_name == "countries":
         df["Country"] = targets
         fig = px.scatter(df, x="Comp-1", y="Comp-2",
-                         hover_name="Country", hover_data={"Id": True, 'Comp-1':False, 'Comp-2':False})
+                         hover_name="Country", hover_data={"Id": True, 'Comp-1':False, 'Comp-2':False}, render_mode="webgl")
     elif dataset_name == "diabetes":
         df["Disease Measure"] = targets
         fig = px.scatter(df, x="Comp-1", y="Comp-2",
-                         hover_name="Disease Measure", hover_data={"Id": True, 'Comp-1':False, 'Comp-2':False})
+                         hover_name="Disease Measure", hover_data={"Id": True, 'Comp-1':False, 'Comp-2':False}, render_mode="webgl")
     elif dataset_name == "zoo":
         df["Animal"] = targets
         fig = px.scatter(df, x="Comp-1", y="Comp-2",
-                         hover_name="Animal", hover_data={"Id": True, 'Comp-1':False, 'Comp-2':False})
-    else:
+                         hover_name="Animal", hover_data={"Id": True, 'Comp-1':False, 'Comp-2':False}, render_mode="webgl")
+    elif dataset_name == "iris":
         df["Class"] = np.array([str(i) for i in targets])
         df["Species"] = np.array([["Setosa", "Versicolor", "Virginica"][i] for i in targets])
         fig = px.scatter(df, x="Comp-1", y="Comp-2",
-                        color="Class", hover_name="Species", hover_data={"Id": True, 'Comp-1':False, 'Comp-2':False})
+                        color="Class", hover_name="Species", hover_data={"Id": True, 'Comp-1':False, 'Comp-2':False}, render_mode="webgl")
+    else:
+        df["Name"] = np.asarray(targets).astype(str)
+        fig = px.scatter(df, x="Comp-1", y="Comp-2",
+                         hover_name="Name", hover_data={"Id": True, 'Comp-1':False, 'Comp-2':False}, render_mode="webgl")
     
     fig.update_layout(
         showlegend=False,
@@ -91,20 +96,64 @@ def create_plot_tsne_embedding(X, Y, targets, dataset_name):
     return fig
 
 
+def compute_feature_grids(X, Y, resolution = 64):
+    """
+    Interpolates every feature of X over a resolution x resolution grid covering the embedding Y, sharing
+    one triangulation between the features. Cells outside the convex hull of Y take the value of the
+    nearest point.
+
+    Return:
+    -------
+    grid_x, grid_y: coordinates of the columns and rows of the grid
+    grids: (nb_features, resolution, resolution) array of the interpolated features
+    """
+    grid_x = np.linspace(np.min(Y[:, 0]), np.max(Y[:, 0]), resolution)
+    grid_y = np.linspace(np.min(Y[:, 1]), np.max(Y[:, 1]), resolution)
+    cells = np.stack(np.meshgrid(grid_x, grid_y), -1).reshape(-1, 2)
+
+    grids = griddata(Y, X, cells, method="linear")
+    outside = np.isnan(grids[:, 0])
+    if np.any(outside):
+        grids[outside] = griddata(Y, X, cells[outside], method="nearest")
+
+    grids = grids.T.reshape(X.shape[1], resolution, resolution).astype(np.float32)
+    return grid_x, grid_y, grids
+
+
+def create_feature_contour_trace(grid_x, grid_y, z):
+    # The rounding only keeps the JSON of the figure short
+    return go.Contour(x=grid_x, y=grid_y, z=np.round(np.asarray(z, dtype=np.float64), 4), hoverinfo='skip', colorscale='Pinkyl', line = dict(width = 0),
+                      name="feature-contour")
+
+
+def create_gradient_arrows_trace(Y, gradients):
+    """Single line trace with one segment from Y[i] to Y[i] + gradients[i] per point, separated by NaNs."""
+
+    segments = np.full((Y.shape[0], 3, 2), np.nan)
+    segments[:, 0] = Y
+    segments[:, 1] = Y + gradients # TODO: DETERMINE SCALING FACTOR
+    segments = segments.reshape(-1, 2)
+
+    return go.Scattergl(x=segments[:, 0], y=segments[:, 1], mode="lines", name="gradient-arrows",
+                        line=dict(color=Color.success.value, width=2), opacity=0.8,
+                        hoverinfo="skip", showlegend=False)
+
+
 ################################
 ####### Explainer plots ########
 ################################
 
 
-def create_feature_importance_ranking_plot(gradients, features):
+def create_feature_importance_ranking_plot(gradients, features, mean_norms=None):
 
-    norms = np.zeros(gradients.shape[2])
+    if mean_norms is None:
+        norms = np.zeros(gradients.shape[2])
 
-    for g in gradients:
-        norm = np.linalg.norm(g, axis=0)
-        norms += (norm / np.sum(norm))
+        for g in gradients:
+            norm = np.linalg.norm(g, axis=0)
+            norms += (norm / np.sum(norm))
 
-    mean_norms = norms/gradients.shape[2]
+        mean_norms = norms/gradients.shape[2]
 
     fig = go.Figure()
 
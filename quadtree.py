@@ -0,0 +1,127 @@
+import numpy as np
+
+
+class QuadTree:
+    """
+    Space-partitioning tree (a quadtree for 2-D embeddings, 2^d children per cell in general) over the
+    points of an embedding, built level by level with NumPy instead of node by node in Python.
+
+    Points are sorted by their Morton code, so that every cell of every level covers a contiguous
+    range [start, end) of the sorted points and the children of a cell are a contiguous range of the
+    next level.
+    """
+
+    def __init__(self, Y, max_depth = None):
+        (n, no_dims) = Y.shape
+        if max_depth is None:
+            max_depth = min(20, 62 // no_dims)
+        self.Y = Y
+        self.no_dims = no_dims
+        self.max_depth = max_depth
+
+        # Bounding box (a hypercube, so that cells stay square)
+        lower = np.min(Y, 0)
+        self.width = max(np.max(np.max(Y, 0) - lower), np.finfo('double').eps) * (1 + 1e-9)
+
+        # Morton code of every point at the deepest level
+        cells = ((Y - lower) / self.width * (1 << max_depth)).astype(np.int64)
+        cells = np.minimum(cells, (1 << max_depth) - 1)
+        codes = np.zeros(n, dtype=np.int64)
+        for bit in range(max_depth):
+            for dim in range(no_dims):
+                codes |= ((cells[:, dim] >> bit) & 1) << (bit * no_dims + dim)
+        self.order = np.argsort(codes, kind="stable")
+        self.rank = np.empty(n, dtype=np.int64)
+        self.rank[self.order] = np.arange(n)
+        codes = codes[self.order]
+        cumsum_Y = np.concatenate((np.zeros((1, no_dims)), np.cumsum(Y[self.order], 0)))
+
+        # Cells of every level, with their point ranges, size and center of mass
+        self.start, self.end, self.count, self.com, self.keys = [], [], [], [], []
+        for level in range(max_depth + 1):
+            keys = codes >> ((max_depth - level) * no_dims)
+            start = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            end = np.r_[start[1:], n]
+            count = end - start
+            self.start.append(start)
+            self.end.append(end)
+            self.count.append(count)
+            self.com.append((cumsum_Y[end] - cumsum_Y[start]) / count[:, np.newaxis])
+            self.keys.append(keys[start])
+
+        # Children of every cell, as a contiguous range of the next level
+        self.child_start, self.child_end = [], []
+        for level in range(max_depth):
+            parent_keys = self.keys[level + 1] >> no_dims
+            self.child_start.append(np.searchsorted(parent_keys, self.keys[level], side="left"))
+            self.child_end.append(np.searchsorted(parent_keys, self.keys[level], side="right"))
+
+    def repulsive_forces(self, theta = 0.5, Y_query = None):
+        """
+        Barnes-Hut estimate of the repulsive t-SNE forces for every point of the tree.
+
+        Parameters:
+        -----------
+        theta: accuracy threshold, a cell is summarized by its center of mass when width / distance < theta
+        Y_query: points outside the tree to compute the forces of all the points of the tree on, instead
+
+        Return:
+        -------
+        neg_f: sum_j num_ij^2 * (y_i - y_j) for every point i, where num_ij = 1 / (1 + ||y_i - y_j||^2)
+        sum_Q: sum_j num_ij for every point i
+        """
+        Y = self.Y if Y_query is None else Y_query
+        n = Y.shape[0]
+        neg_f = np.zeros((n, self.no_dims))
+        sum_Q = np.zeros(n)
+
+        # Every point starts against the root cell
+        points = np.arange(n)
+        nodes = np.zeros(n, dtype=np.int64)
+
+        for level in range(self.max_depth + 1):
+            if points.size == 0:
+                break
+
+            count = self.count[level][nodes]
+            com = self.com[level][nodes]
+
+            # Exclude the point itself from the cells that contain it
+            if Y_query is None:
+                rank = self.rank[points]
+                inside = (self.start[level][nodes] <= rank) & (rank < self.end[level][nodes])
+            else:
+                inside = np.zeros(points.size, dtype=bool)
+            if np.any(inside):
+                com = com.copy()
+                count = count - inside
+                keep = inside & (count > 0)
+                com[keep] = (com[keep] * (count[keep] + 1)[:, np.newaxis] - Y[points[keep]]) / count[keep][:, np.newaxis]
+
+            diff = Y[points] - com
+            dist = np.sum(np.square(diff), 1)
+            cell_width = self.width / (1 << level)
+
+            # Summarize leaves and cells that are far enough away, open the others
+            if level == self.max_depth:
+                summarize = np.ones(points.size, dtype=bool)
+            else:
+                summarize = (self.count[level][nodes] == 1) | (cell_width * cell_width < theta * theta * dist)
+            summarize &= count > 0
+
+            q = 1 / (1 + dist[summarize])
+            sum_Q += np.bincount(points[summarize], count[summarize] * q, minlength=n)
+            weights = count[summarize] * q * q
+            for dim in range(self.no_dims):
+                neg_f[:, dim] += np.bincount(points[summarize], weights * diff[summarize, dim], minlength=n)
+
+            opened = ~summarize & (count > 0)
+            if level == self.max_depth or not np.any(opened):
+                break
+            first = self.child_start[level][nodes[opened]]
+            nb_children = self.child_end[level][nodes[opened]] - first
+            points = np.repeat(points[opened], nb_children)
+            offsets = np.arange(nb_children.sum()) - np.repeat(np.cumsum(nb_children) - nb_children, nb_children)
+            nodes = np.repeat(first, nb_children) + offsets
+
+        return neg_f, sum_Q
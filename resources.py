@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import diskcache
+import psutil
+from threadpoolctl import threadpool_limits
+
+
+def available_cpus():
+    """Number of CPUs the process may run on."""
+
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class ComputeResources:
+    """
+    Thread budget of the compute jobs (t-SNE runs, explanations) of all the processes of the app.
+
+    Every job registers itself in a diskcache shared by the processes (gunicorn workers and background
+    callback workers), and the max_threads threads are split evenly between the registered jobs. The share of
+    a job is applied to the BLAS and OpenMP thread pools of its process with threadpoolctl when it starts and
+    every time it calls refresh(), so that concurrent jobs stop oversubscribing the cores as soon as they
+    notice each other. The thread pools are process-wide, so concurrent jobs of one process share the same
+    limit, the share of the last one to start or refresh. A job whose process died (a cancelled background
+    callback is killed before it can unregister) or that has not refreshed for ttl seconds is no longer
+    counted.
+
+    Parameters:
+    -----------
+    directory: where the jobs are registered, shared by the processes
+    max_threads: threads of all the jobs together, the CPUs available to the process when None
+    min_threads: threads a job gets however many jobs are running
+    ttl: seconds after which a job that has not refreshed is forgotten
+    """
+
+    def __init__(self, directory = "cache", max_threads = None, min_threads = 1, ttl = 600):
+        self.jobs = diskcache.Cache(directory)
+        self.max_threads = max_threads if max_threads is not None else available_cpus()
+        self.min_threads = min_threads
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._local_jobs = set()
+        self._limiter = None
+
+    def threads_per_job(self, active_jobs = None):
+        """Threads of every job when active_jobs jobs (the registered ones when None) are running."""
+
+        if active_jobs is None:
+            active_jobs = self.active_jobs()
+        return max(self.min_threads, self.max_threads // max(1, active_jobs))
+
+    def active_jobs(self):
+        return len(self._live_jobs())
+
+    @contextmanager
+    def job(self, name):
+        """
+        Runs the block as the job name with its share of the threads, and yields the id to pass to refresh.
+        """
+        job_id = uuid.uuid4().hex
+        self.jobs.set(job_id, {"name": name, "pid": os.getpid(), "created": psutil.Process().create_time(),
+                               "started": time.time()}, expire=self.ttl)
+        with self._lock:
+            self._local_jobs.add(job_id)
+        try:
+            self._apply()
+            yield job_id
+        finally:
+            self.jobs.delete(job_id)
+            with self._lock:
+                self._local_jobs.discard(job_id)
+            self._apply()
+
+    def refresh(self, job_id):
+        """Keeps the job registered and applies its current share of the threads."""
+
+        self.jobs.touch(job_id, expire=self.ttl)
+        self._apply()
+
+    def worker_threads(self, n_workers):
+        """Threads of each of the n_workers worker processes a job spreads its computation over."""
+
+        return max(1, self.threads_per_job() // n_workers)
+
+    def allocation(self):
+        """Current split of the threads: the budget, the registered jobs and the threads of every job."""
+
+        jobs = self._live_jobs()
+        threads = self.threads_per_job(len(jobs))
+        return {"max_threads": self.max_threads, "min_threads": self.min_threads, "active_jobs": len(jobs),
+                "threads_per_job": threads, "jobs": [dict(job, threads=threads) for job in jobs]}
+
+    def _live_jobs(self):
+        """Registered jobs whose process is alive, forgetting the expired ones and those of dead processes."""
+
+        self.jobs.expire()
+        jobs = []
+        for key in list(self.jobs):
+            info = self.jobs.get(key)
+            if info is None:
+                continue
+            if not _process_alive(info["pid"], info.get("created")):
+                self.jobs.delete(key)
+                continue
+            jobs.append({"id": key, **info})
+        return jobs
+
+    def _apply(self):
+        # The limiter created for the first job keeps the original limits, restored when the process has no job left
+        with self._lock:
+            if not self._local_jobs:
+                if self._limiter is not None:
+                    self._limiter.restore_original_limits()
+                    self._limiter = None
+                return
+            threads = self.threads_per_job()
+            if self._limiter is None:
+                self._limiter = threadpool_limits(limits=threads)
+            else:
+                threadpool_limits(limits=threads)
+
+
+def _process_alive(pid, created):
+    """Whether the process pid is running and, when created is given, is the one created at that time
+    rather than a later process reusing its pid."""
+
+    try:
+        process = psutil.Process(pid)
+        return process.status() != psutil.STATUS_ZOMBIE and (created is None or process.create_time() == created)
+    except psutil.NoSuchProcess:
+        return False
+    except psutil.AccessDenied:
+        return True
+
+
+compute_resources = ComputeResources(os.path.join("cache", "resources"))
@@ -1,144 +1,608 @@
+import logging
+import tempfile
+
 import numpy as np
 import pandas as pd
+import psutil
 import plotly.express as px
 import plotly.graph_objects as go
+from scipy import sparse
+from sklearn.neighbors import NearestNeighbors
+
+from instrumentation import Phase, default_observer
+from quadtree import QuadTree
+
+
+def _Hbeta(D = np.array([[]]), beta = np.ones((1, 1)), diagonal = None):
+    """Compute the perplexities and the P-rows for the precisions beta (a column) of a batch of Gaussian distributions.
+    diagonal optionally gives, for every row of D, the column of the point itself, which is left out of its P-row."""
+
+    # Compute P-rows and corresponding perplexities
+    P = np.exp(-D * beta)
+    if diagonal is not None:
+        P[np.arange(D.shape[0]), diagonal] = 0
+    sumP = np.maximum(np.sum(P, 1), np.finfo('double').eps)
+    H = np.log(sumP) + beta[:, 0] * np.sum(D * P, 1) / sumP
+    P /= sumP[:, np.newaxis]
+    return H, P
+
+
+def _x2d(X = np.array([]), perplexity = 30.0, method = "exact", X_fit = None, observer = None):
+    """Computes the squared distances _x2p calibrates the P-values on: between all points of X (or from the points of
+    X to the points of X_fit) with method="exact", or to the 3*perplexity nearest neighbours of every point with
+    method="knn". Returns the distances and the neighbours (None with method="exact"), so that they can be reused
+    by several calls to _x2p with a perplexity up to this one. The computation is reported to observer as the
+    "distances" phase (see instrumentation.Observer)."""
 
+    (n, d) = X.shape
+    n_fit = n if X_fit is None else X_fit.shape[0]
+    with Phase(observer, "distances", method=method):
+        if method == "knn":
+            if X_fit is None:
+                k = min(n - 1, int(3 * perplexity))
+                distances, neighbors = NearestNeighbors(n_neighbors=k).fit(X).kneighbors()
+            else:
+                k = min(n_fit, int(3 * perplexity))
+                distances, neighbors = NearestNeighbors(n_neighbors=k).fit(X_fit).kneighbors(X)
+            return np.square(distances), neighbors
 
-def _Hbeta(D = np.array([]), beta = 1.0):
-        """Compute the perplexity and the P-row for a specific value of the precision of a Gaussian distribution."""
+        sum_X = np.sum(np.square(X), 1)
+        if X_fit is None:
+            return np.add(np.add(-2 * np.dot(X, X.T), sum_X).T, sum_X), None
+        return np.maximum(sum_X[:, np.newaxis] - 2 * np.dot(X, X_fit.T) + np.sum(np.square(X_fit), 1), 0), None
 
-        # Compute P-row and corresponding perplexity
-        P = np.exp(-D.copy() * beta)
-        sumP = np.maximum(sum(P), np.finfo('double').eps)
-        H = np.log(sumP) + beta * np.sum(D * P) / sumP
-        P = P / sumP
-        return H, P
-    
 
-def _x2p(X = np.array([]), tol = 1e-5, perplexity = 30.0):
-    """Performs a binary search to get P-values in such a way that each conditional Gaussian has the same perplexity."""
+def _x2p(X = np.array([]), tol = 1e-5, perplexity = 30.0, method = "exact", chunk_size = 1000, progress = None,
+         X_fit = None, distances = None, memory_budget = None, out = None, observer = None):
+    """Performs a binary search to get P-values in such a way that each conditional Gaussian has the same perplexity.
+    The search runs on chunk_size rows at a time, bisecting the precisions of all rows of the chunk together.
+    With method="knn", only the 3*perplexity nearest neighbours of every point are found with a spatial index,
+    the search runs on those only and P is returned as a CSR matrix, so memory grows linearly with n.
+    With X_fit, the rows of P are the distributions of the points of X over the points of X_fit instead.
+    distances optionally gives the output of _x2d for the same X, method and X_fit, and a perplexity at least as large.
+    With memory_budget (in bytes) and method="exact", the distances are computed chunk by chunk instead, with chunks
+    small enough for their temporaries to fit in the budget, and the rows of P are written into out when given
+    (an NxN array or np.memmap).
+    progress, if given, is called as progress("P-values", rows_done, n) after every chunk, and every chunk is reported
+    to observer as a "calibration" phase (see instrumentation.Observer)."""
 
     # Initialize some variables
-    print("Computing pairwise distances...")
+    observer = observer if observer is not None else default_observer
     (n, d) = X.shape
-    sum_X = np.sum(np.square(X), 1)
-    D = np.add(np.add(-2 * np.dot(X, X.T), sum_X).T, sum_X)
-    P = np.zeros((n, n))
+    n_fit = n if X_fit is None else X_fit.shape[0]
+    blocked = memory_budget is not None and method == "exact" and distances is None
+    if blocked:
+        chunk_size = _block_rows(n_fit, memory_budget, 6)
+        self_rows = X_fit is None
+        X_fit = X if X_fit is None else X_fit
+        sum_X = np.sum(np.square(X), 1)
+        sum_fit = np.sum(np.square(X_fit), 1)
+    else:
+        if distances is None:
+            distances = _x2d(X, perplexity, method, X_fit, observer)
+        (D, neighbors) = distances
+    if method == "knn":
+        k = min(D.shape[1], int(3 * perplexity))
+        D = D[:, :k]
+        neighbors = neighbors[:, :k]
+        P = np.zeros((n, k))
+    elif out is not None:
+        P = out
+    else:
+        P = np.zeros((n, n_fit))
     beta = np.ones((n, 1))
     logU = np.log(perplexity)
 
-    # Loop over all datapoints
-    for i in range(n):
+    # Loop over chunks of datapoints
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        rows = np.arange(start, end)
 
-        # Print progress
-        if i % 500 == 0:
-            print("Computing P-values for point ", i, " of ", n, "...")
+        chunk = Phase(observer, "calibration", chunk="%d-%d of %d" % (start, end, n)).start()
 
-        # Compute the Gaussian kernel and entropy for the current precision
-        betamin = -np.inf
-        betamax =  np.inf
-        Di = D[i, np.concatenate((np.r_[0:i], np.r_[i+1:n]))]
-        (H, thisP) = _Hbeta(Di, beta[i])
-            
-        # Evaluate whether the perplexity is within tolerance
+        # Compute the Gaussian kernels and entropies for the current precisions
+        if blocked:
+            Dc = np.add(np.add(-2 * np.dot(X[start:end], X_fit.T), sum_X[start:end, np.newaxis]), sum_fit)
+            diagonal = rows if self_rows else None
+        else:
+            Dc = D[start:end]
+            diagonal = None if method == "knn" or X_fit is not None else rows
+        betamin = np.full(end - start, -np.inf)
+        betamax = np.full(end - start, np.inf)
+        (H, thisP) = _Hbeta(Dc, beta[rows], diagonal)
+
+        # Evaluate which perplexities are not within tolerance yet
         Hdiff = H - logU
+        active = np.flatnonzero(np.isnan(Hdiff) | (np.abs(Hdiff) > tol))
         tries = 0
-        while (np.isnan(Hdiff) or np.abs(Hdiff) > tol) and tries < 50:
-                
+        while active.size > 0 and tries < 50:
+
             # If not, increase or decrease precision
-            if Hdiff > 0:
-                betamin = beta[i]
-                if betamax == np.inf or betamax == -np.inf:
-                    beta[i] = beta[i] * 2
-                else:
-                    beta[i] = (beta[i] + betamax) / 2
-            else:
-                betamax = beta[i]
-                if betamin == np.inf or betamin == -np.inf:
-                    beta[i] = beta[i] / 2
-                else:
-                    beta[i] = (beta[i] + betamin) / 2
-            
-            # Recompute the values
-            (H, thisP) = _Hbeta(Di, beta[i])
-            Hdiff = H - logU
+            i = rows[active]
+            higher = Hdiff[active] > 0
+            up, down = active[higher], active[~higher]
+            betamin[up] = beta[rows[up], 0]
+            betamax[down] = beta[rows[down], 0]
+            beta[rows[up], 0] = np.where(np.isinf(betamax[up]), beta[rows[up], 0] * 2, (beta[rows[up], 0] + betamax[up]) / 2)
+            beta[rows[down], 0] = np.where(np.isinf(betamin[down]), beta[rows[down], 0] / 2, (beta[rows[down], 0] + betamin[down]) / 2)
+
+            # Recompute the values of the rows that have not converged
+            (H, thisP[active]) = _Hbeta(Dc[active], beta[i], None if diagonal is None else i)
+            Hdiff[active] = H - logU
+            active = active[np.isnan(Hdiff[active]) | (np.abs(Hdiff[active]) > tol)]
             tries = tries + 1
-            
-        # Set the final row of P
-        P[i, np.concatenate((np.r_[0:i], np.r_[i+1:n]))] = thisP
+
+        # Set the final rows of P
+        P[start:end] = thisP
+        chunk.end()
+        if progress is not None:
+            progress("P-values", end, n)
+
+    if method == "knn":
+        P = sparse.csr_matrix((P.ravel(), neighbors.ravel(), np.arange(0, n * k + 1, k)), shape=(n, n_fit))
 
     # Return final P-matrix
-    print("Mean value of sigma: ", np.mean(np.sqrt(1 / beta)))
-    
+    observer.message("Mean value of sigma: %s" % np.mean(np.sqrt(1 / beta)))
+
     return P, np.sqrt(1 / beta)
 
 
-def compute_tsne(X, no_dims = 2, perplexity = 30.0, max_iter = 400, Y_init = None):
+def _exact_gradient(Y, P, num, Q, PQ, dY):
+    """Computes the exact t-SNE gradient in place, reusing the preallocated NxN buffers num, Q and PQ.
+    On return num holds the Student-t kernel, Q the (clipped) joint probabilities and dY the gradient."""
+
+    n = Y.shape[0]
+
+    # Compute pairwise affinities
+    sum_Y = np.sum(np.square(Y), 1)
+    np.dot(Y, Y.T, out=num)
+    num *= -2
+    num += sum_Y
+    num += sum_Y[:, np.newaxis]
+    num += 1
+    np.reciprocal(num, out=num)
+    num[range(n), range(n)] = 0
+    np.divide(num, np.sum(num), out=Q)
+    np.maximum(Q, 1e-12, out=Q)
+
+    # Compute gradient: dY_i = sum_j (p_ij - q_ij) * num_ij * (y_i - y_j)
+    np.subtract(P, Q, out=PQ)
+    PQ *= num
+    np.dot(PQ, Y, out=dY)
+    np.subtract(np.sum(PQ, 1)[:, np.newaxis] * Y, dY, out=dY)
+
+    return dY
+
+
+def _block_rows(n, memory_budget, nb_buffers = 4):
+    """Number of rows of the blocks of an NxN matrix for nb_buffers float64 temporaries of a block to fit in memory_budget bytes."""
+
+    return int(max(1, min(n, memory_budget // (nb_buffers * n * 8))))
+
+
+def _kernel_block(Y, start, end):
+    """Student-t kernel num_ij = 1 / (1 + ||y_i - y_j||^2) between the rows start to end of Y and all of Y, with num_ii = 0."""
+
+    sum_Y = np.sum(np.square(Y), 1)
+    num = np.dot(Y[start:end], Y.T)
+    num *= -2
+    num += sum_Y
+    num += sum_Y[start:end, np.newaxis]
+    num += 1
+    np.reciprocal(num, out=num)
+    num[np.arange(end - start), np.arange(start, end)] = 0
+    return num
+
+
+def _exact_gradient_blocked(Y, P, dY, block):
+    """Computes the exact t-SNE gradient into dY block rows at a time, without any NxN temporary.
+    dY_i = sum_j p_ij * num_ij * (y_i - y_j) - (1 / sum_Q) * sum_j num_ij^2 * (y_i - y_j), so the attractive and
+    the (unnormalized) repulsive forces are accumulated in one pass, together with sum_Q. Unlike _exact_gradient,
+    Q is not clipped at 1e-12. Returns sum_Q."""
+
+    n = Y.shape[0]
+    neg_f = np.empty_like(dY)
+    sum_Q = 0
+    for start in range(0, n, block):
+        end = min(start + block, n)
+        num = _kernel_block(Y, start, end)
+        sum_Q += np.sum(num)
+        W = P[start:end] * num
+        dY[start:end] = np.sum(W, 1)[:, np.newaxis] * Y[start:end] - np.dot(W, Y)
+        np.square(num, out=num)
+        neg_f[start:end] = np.sum(num, 1)[:, np.newaxis] * Y[start:end] - np.dot(num, Y)
+    dY -= neg_f / sum_Q
+    return sum_Q
+
+
+def _symmetrize_blocked(P, block):
+    """Replaces P by P + P.T in place, block by block. Returns the sum of the result."""
+
+    n = P.shape[0]
+    total = 0
+    for start in range(0, n, block):
+        I = slice(start, min(start + block, n))
+        for other in range(start, n, block):
+            J = slice(other, min(other + block, n))
+            S = P[I, J] + P[J, I].T
+            P[I, J] = S
+            P[J, I] = S.T
+            total += np.sum(S) if other == start else 2 * np.sum(S)
+    return total
+
+
+class QMatrix:
+    """On-demand view of the t-SNE Q matrix of an embedding Y, for engines that never materialize it.
+    Rows are computed when indexed, Q[i] = (1 / (1 + ||y_i - y_j||^2)) / sum_Q with Q[i, i] = 0.
+    Indexing with an array of row indices returns the corresponding 2-D block of rows."""
+
+    def __init__(self, Y, sum_Q):
+        self.Y = Y
+        self.sum_Q = sum_Q
+        self.shape = (Y.shape[0], Y.shape[0])
+
+    @classmethod
+    def of_embedding(cls, Y, block = 1024):
+        """QMatrix of the embedding Y, with the exact normalization sum_Q summed by blocks of rows."""
+
+        n = Y.shape[0]
+        return cls(Y, sum(np.sum(_kernel_block(Y, start, min(start + block, n))) for start in range(0, n, block)))
+
+    def __getitem__(self, i):
+        rows = np.atleast_1d(i)
+        q = 1 / (1 + np.sum(np.square(self.Y[rows][:, np.newaxis, :] - self.Y), 2))
+        q[np.arange(rows.size), rows] = 0
+        q /= self.sum_Q
+        return q[0] if np.ndim(i) == 0 else q
+
+    def toarray(self):
+        return np.array([self[i] for i in range(self.shape[0])])
+
+
+def _barnes_hut_gradient(Y, P, dY, theta):
+    """Computes the t-SNE gradient with exact attractive forces over the sparse P and Barnes-Hut repulsive forces.
+    Returns the normalization sum_Q and the Student-t kernel on the non-zero entries of P."""
+
+    n = Y.shape[0]
+
+    # Attractive forces: sum_j p_ij * num_ij * (y_i - y_j) over the neighbours of i
+    rows = np.repeat(np.arange(n), np.diff(P.indptr))
+    num = 1 / (1 + np.sum(np.square(Y[rows] - Y[P.indices]), 1))
+    W = sparse.csr_matrix((P.data * num, P.indices, P.indptr), shape=P.shape)
+    pos_f = np.asarray(W.sum(1)) * Y - W @ Y
+
+    # Repulsive forces: sum_j q_ij * num_ij * (y_i - y_j), approximated with the quadtree
+    neg_f, sum_Q = QuadTree(Y).repulsive_forces(theta)
+    sum_Q = np.sum(sum_Q)
+    dY[:] = pos_f - neg_f / sum_Q
+
+    return sum_Q, num
+
+
+def compute_tsne(X, no_dims = 2, perplexity = 30.0, max_iter = 400, Y_init = None, dtype = np.float64,
+                 method = "exact", theta = 0.5, seed = None, progress = None, snapshot = None, snapshot_every = 10,
+                 learning_rate = 500, exaggeration_iter = 100, min_grad_norm = 0.0, kl_tol = 0.0, n_iter_check = 50,
+                 return_n_iter = False, distances = None, memory_budget = None, memmap_file = None, observer = None):
     """Runs t-SNE on the dataset in the NxD array X to reduce its dimensionality to no_dims dimensions.
-    The syntaxis of the function is Y = tsne.tsne(X, no_dims, perplexity), where X is an NxD NumPy array."""
+    The syntaxis of the function is Y = tsne.tsne(X, no_dims, perplexity), where X is an NxD NumPy array.
+    The optimizer runs in the given dtype; use np.float32 to halve the memory of the NxN buffers.
+    With method="barnes_hut", P is kept sparse over the 3*perplexity nearest neighbours, the repulsive forces
+    are approximated with a quadtree of accuracy theta, and Q is returned as an on-demand QMatrix.
+    The random initial embedding is drawn from seed, so that runs with the same seed are reproducible.
+    progress, if given, is called as progress(phase, done, total) while the P-values are computed and after
+    every iteration, with phase "P-values" or "iterations".
+    snapshot, if given, is called as snapshot(iteration, Y, cost) every snapshot_every iterations (see tsne_steps);
+    when it returns True the optimization stops early and the current embedding is returned.
+    learning_rate and exaggeration_iter can be "auto" to scale them with n, and after the early exaggeration
+    the optimization stops once the gradient norm falls below min_grad_norm or the KL divergence, checked every
+    n_iter_check iterations, changes by less than kl_tol relatively; exaggeration_iter=0 skips the early exaggeration.
+    With return_n_iter, the number of iterations actually run is returned as a fifth value.
+    distances optionally gives precomputed distances for the P-values (see _x2d and compute_tsne_sweep).
+    With method="exact" and a memory_budget in bytes, the distances, gradients and costs are computed by blocks of
+    rows whose temporaries fit in the budget, so that P is the only NxN array, and Q is returned as a QMatrix.
+    P is then backed by the np.memmap file memmap_file when given, or by a temporary file with memmap_file="auto"
+    when it does not fit in the available memory.
+    observer, an instrumentation.Observer, receives the phases of the run ("distances", "calibration",
+    "symmetrization", "early exaggeration", "optimization", "final Q") with their timings, the costs and
+    the messages; they go to instrumentation.default_observer, which logs them, when it is None."""
+
+    steps = tsne_steps(X, no_dims, perplexity, max_iter, Y_init, dtype, method, theta, seed, progress,
+                       snapshot_every if snapshot is not None else None,
+                       learning_rate, exaggeration_iter, min_grad_norm, kl_tol, n_iter_check, distances,
+                       memory_budget, memmap_file, observer)
+    try:
+        step = next(steps)
+        while True:
+            step = steps.send(bool(snapshot(*step)))
+    except StopIteration as result:
+        if isinstance(result.value, int) or return_n_iter:
+            return result.value
+        return result.value[:4]
+
+
+def _auto_schedule(n, learning_rate, exaggeration_iter):
+    """Learning rate and length of the early exaggeration scaled to the number of points n.
+    The learning rate follows the max(n / exaggeration / 4, 50) rule of Belkina et al. (2019), times 4 since the
+    gradient of this implementation leaves out the constant factor 4; the exaggeration lasts longer on larger
+    datasets, from 50 iterations up to 250."""
+
+    if learning_rate == "auto":
+        learning_rate = max(n / 4, 200)
+    if exaggeration_iter == "auto":
+        exaggeration_iter = int(min(250, max(50, n / 20)))
+    return learning_rate, exaggeration_iter
+
+
+def tsne_steps(X, no_dims = 2, perplexity = 30.0, max_iter = 400, Y_init = None, dtype = np.float64,
+               method = "exact", theta = 0.5, seed = None, progress = None, snapshot_every = 10,
+               learning_rate = 500, exaggeration_iter = 100, min_grad_norm = 0.0, kl_tol = 0.0, n_iter_check = 50,
+               distances = None, memory_budget = None, memmap_file = None, observer = None):
+    """Generator running the t-SNE optimization of compute_tsne, which yields (iteration, Y, cost) every
+    snapshot_every iterations and after the last one (never when snapshot_every is None). The yielded Y is
+    not modified by later iterations, so it is not copied. Sending True stops the optimization early.
+    The generator returns the (Y, P, Q, sigma, n_iter) of compute_tsne."""
 
     # Check inputs
+    observer = observer if observer is not None else default_observer
     if X.dtype != "float64":
-        print("Error: array X should have type float64.")
+        observer.message("Error: array X should have type float64.", logging.ERROR)
         return -1
     #if no_dims.__class__ != "<type 'int'>":			# doesn't work yet!
     #	print "Error: number of dimensions should be an integer.";
     #	return -1;
 
+    if method not in ("exact", "barnes_hut"):
+        observer.message("Error: method should be 'exact' or 'barnes_hut'.", logging.ERROR)
+        return -1
+
     (n, d) = X.shape
 
     initial_momentum = 0.5
     final_momentum = 0.8
-    eta = 500
+    eta, exaggeration_iter = _auto_schedule(n, learning_rate, exaggeration_iter)
     min_gain = 0.01
     if not isinstance(Y_init, np.ndarray):
-        Y = np.random.randn(n, no_dims)
+        Y = np.random.RandomState(seed).randn(n, no_dims).astype(dtype)
     else:
-        Y = Y_init.copy()
-    dY = np.zeros((n, no_dims))
-    iY = np.zeros((n, no_dims))
-    gains = np.ones((n, no_dims))
+        Y = Y_init.astype(dtype)
+    dY = np.zeros((n, no_dims), dtype=dtype)
+    iY = np.zeros((n, no_dims), dtype=dtype)
+    gains = np.ones((n, no_dims), dtype=dtype)
+
+    exaggeration = 4 if exaggeration_iter > 0 else 1
+    blocked = method == "exact" and memory_budget is not None
 
     # Compute P-values
-    P, sigma = _x2p(X, 1e-5, perplexity)
-    P = P + np.transpose(P)
-    P = P / np.sum(P)
-    P = P * 4 # early exaggeration
-    P = np.maximum(P, 1e-12)
+    if blocked:
+        # P is built in place, in the optimizer dtype, by blocks of rows
+        block = _block_rows(n, memory_budget)
+        if memmap_file == "auto":
+            memmap_file = tempfile.TemporaryFile() if n * n * np.dtype(dtype).itemsize > psutil.virtual_memory().available else None
+        if memmap_file is not None:
+            P = np.memmap(memmap_file, dtype=dtype, mode="w+", shape=(n, n))
+        else:
+            P = np.empty((n, n), dtype=dtype)
+        P, sigma = _x2p(X, 1e-5, perplexity, progress=progress, memory_budget=memory_budget, out=P, observer=observer)
+        with Phase(observer, "symmetrization"):
+            total = _symmetrize_blocked(P, block)
+            for start in range(0, n, block):
+                rows = P[start:start + block]
+                rows *= exaggeration / total # early exaggeration
+                np.maximum(rows, 1e-12, out=rows)
+    else:
+        P, sigma = _x2p(X, 1e-5, perplexity, method="knn" if method == "barnes_hut" else "exact", progress=progress,
+                        distances=distances, observer=observer)
+        with Phase(observer, "symmetrization"):
+            P = P + P.T
+            P = P / P.sum()
+            P = P * exaggeration # early exaggeration
+            if method == "exact":
+                P = np.maximum(P, 1e-12)
+            P = P.astype(dtype)
 
-    # Run iterations
-    for iter in range(max_iter):
-        
-        # Compute pairwise affinities
-        sum_Y = np.sum(np.square(Y), 1)
-        num = 1 / (1 + np.add(np.add(-2 * np.dot(Y, Y.T), sum_Y).T, sum_Y))
-        num[range(n), range(n)] = 0
-        Q = num / np.sum(num)
-        Q = np.maximum(Q, 1e-12)
+    # Preallocate the NxN buffers reused by every iteration
+    if method == "exact" and not blocked:
+        num = np.empty((n, n), dtype=dtype)
+        Q = np.empty((n, n), dtype=dtype)
+        PQ = np.empty((n, n), dtype=dtype)
+
+    # KL(P || Q) = sum P log P - sum P log Q, where the first term only changes with the exaggeration
+    # and the logarithms go through the PQ buffer, which is free between two gradient evaluations
+    def entropy_term():
+        if blocked:
+            return sum(np.vdot(P[start:start + block], np.log(P[start:start + block])) for start in range(0, n, block))
+        if method == "exact":
+            np.log(P, out=PQ)
+            return np.vdot(P, PQ)
+        return np.sum(P.data * np.log(P.data))
+
+    def cost():
+        if blocked:
+            return PlogP - sum(np.vdot(P[start:start + block], np.log(np.maximum(_kernel_block(Y_grad, start, min(start + block, n)) / sum_Q, 1e-12)))
+                               for start in range(0, n, block))
+        if method == "exact":
+            np.log(Q, out=PQ)
+            return PlogP - np.vdot(P, PQ)
+        return PlogP - np.sum(P.data * np.log(np.maximum(num / sum_Q, 1e-12)))
+
+    PlogP = entropy_term()
+    C_check = None
+    n_iter = 0
+
+    # Run iterations, timed as the early exaggeration and the rest of the optimization
+    phase = Phase(observer, "early exaggeration" if exaggeration != 1 else "optimization").start()
+    try:
+        for iter in range(max_iter):
         
-        # Compute gradient
-        PQ = P - Q
-        for i in range(n):
-            dY[i,:] = np.sum(np.tile(PQ[:,i] * num[:,i], (no_dims, 1)).T * (Y[i,:] - Y), 0)
+            # Compute pairwise affinities and gradient
+            if blocked:
+                Y_grad = Y
+                sum_Q = _exact_gradient_blocked(Y, P, dY, block)
+            elif method == "exact":
+                _exact_gradient(Y, P, num, Q, PQ, dY)
+            else:
+                sum_Q, num = _barnes_hut_gradient(Y, P, dY, theta)
             
-        # Perform the update
-        if iter < 20:
-            momentum = initial_momentum
-        else:
-            momentum = final_momentum
-        gains = (gains + 0.2) * ((dY > 0) != (iY > 0)) + (gains * 0.8) * ((dY > 0) == (iY > 0))
-        gains[gains < min_gain] = min_gain
-        iY = momentum * iY - eta * (gains * dY)
-        Y = Y + iY
-        Y = Y - np.tile(np.mean(Y, 0), (n, 1))
+            # Perform the update
+            if iter < 20:
+                momentum = initial_momentum
+            else:
+                momentum = final_momentum
+            gains = (gains + 0.2) * ((dY > 0) != (iY > 0)) + (gains * 0.8) * ((dY > 0) == (iY > 0))
+            gains[gains < min_gain] = min_gain
+            iY = momentum * iY - eta * (gains * dY)
+            Y = Y + iY
+            Y = Y - np.mean(Y, 0)
         
-        # Compute current value of cost function
-        if (iter + 1) % 100 == 0:
-            C = np.sum(P * np.log(P / Q))
-            print("Iteration ", (iter + 1), ": error is ", C)
-            
-        # Stop lying about P-values
-        if iter == 100:
-            P = P / 4
+            n_iter = iter + 1
+
+            # Compute current value of cost function
+            C = None
+            if (iter + 1) % 100 == 0:
+                C = cost()
+
+            # Check convergence once the exaggeration is over
+            converged = False
+            if iter > exaggeration_iter:
+                if min_grad_norm > 0 and np.linalg.norm(dY) < min_grad_norm:
+                    observer.message("Iteration %d: gradient norm below %s, stopping" % (iter + 1, min_grad_norm))
+                    converged = True
+                elif kl_tol > 0 and (iter - exaggeration_iter) % n_iter_check == 0:
+                    C = C if C is not None else cost()
+                    if C_check is not None and np.abs(C_check - C) < kl_tol * np.abs(C_check):
+                        observer.message("Iteration %d: relative change of the error below %s, stopping" % (iter + 1, kl_tol))
+                        converged = True
+                    C_check = C
+            if C is not None:
+                observer.iteration(iter + 1, C)
+
+            # Stop lying about P-values
+            if iter == exaggeration_iter and exaggeration != 1:
+                if blocked:
+                    P /= exaggeration
+                else:
+                    P = P / exaggeration
+                PlogP = entropy_term()
+                phase.end()
+                phase = Phase(observer, "optimization").start()
+
+            if progress is not None:
+                progress("iterations", iter + 1, max_iter)
+
+            # Hand out a snapshot, and stop if asked to
+            if snapshot_every is not None and ((iter + 1) % snapshot_every == 0 or iter + 1 == max_iter or converged):
+                stop = yield (iter + 1, Y, C if C is not None else cost())
+                if stop:
+                    if iter < exaggeration_iter:
+                        if blocked:
+                            P /= exaggeration
+                        else:
+                            P = P / exaggeration
+                    break
+
+            if converged:
+                break
+    finally:
+        phase.end()
+
+    if method == "barnes_hut" or blocked:
+        with Phase(observer, "final Q"):
+            if method == "barnes_hut":
+                Q = QMatrix(Y, np.sum(QuadTree(Y).repulsive_forces(theta)[1]))
+            else:
+                Q = QMatrix.of_embedding(Y, block)
+
+    return Y, P, Q, sigma, n_iter
+
+
+def compute_tsne_sweep(X, perplexities, no_dims = 2, max_iter = 400, method = "exact", warm_start = True, **params):
+    """Runs compute_tsne on X for every perplexity of the list perplexities, in order, computing the pairwise
+    distances (or the nearest neighbours for the largest perplexity) only once. With warm_start, every run
+    starts from the embedding of the previous one, without early exaggeration.
+    Other params, observer included, are passed to compute_tsne.
+    Returns the list of the (Y, P, Q, sigma) of every perplexity."""
+
+    observer = params.get("observer") if params.get("observer") is not None else default_observer
+    if X.dtype != "float64":
+        observer.message("Error: array X should have type float64.", logging.ERROR)
+        return -1
+
+    distances = _x2d(X, max(perplexities), "knn" if method == "barnes_hut" else "exact", observer=observer)
+    results = []
+    Y_init = params.pop("Y_init", None)
+    exaggeration_iter = params.pop("exaggeration_iter", 100)
+    for perplexity in perplexities:
+        observer.message("Running t-SNE with perplexity %s..." % perplexity)
+        result = compute_tsne(X, no_dims, perplexity, max_iter, Y_init=Y_init, method=method, distances=distances,
+                              exaggeration_iter=exaggeration_iter if Y_init is None else 0, **params)
+        results.append(result)
+        if warm_start:
+            Y_init = result[0]
+    return results
+
+
+def transform_tsne(X_new, X, Y, perplexity = 5.0, max_iter = 250, method = "exact", theta = 0.5,
+                   learning_rate = 0.5, progress = None, observer = None):
+    """Places the points of the array X_new into the existing embedding Y of the points X, which stays fixed.
+    The P-rows of the new points are computed against X, every new point starts at the P-weighted mean of
+    the embedding and only the new coordinates are optimized, each new point against the points of Y alone.
+    As P-rows sum to one here, the learning rate is much smaller than for compute_tsne, and a low perplexity
+    keeps new points from being pulled to the middle of the embedding (Policar et al., 2019).
+    method, theta, progress and observer are those of compute_tsne, the optimization being the "transform" phase.
+    Returns the embedding Y_new of the new points, their P-rows and their sigma."""
+
+    # Check inputs
+    observer = observer if observer is not None else default_observer
+    if X_new.dtype != "float64":
+        observer.message("Error: array X_new should have type float64.", logging.ERROR)
+        return -1
+
+    if method not in ("exact", "barnes_hut"):
+        observer.message("Error: method should be 'exact' or 'barnes_hut'.", logging.ERROR)
+        return -1
+
+    n_new = X_new.shape[0]
+    Y = np.asarray(Y, dtype=np.float64)
+    initial_momentum = 0.5
+    final_momentum = 0.8
+    min_gain = 0.01
+
+    # Compute P-values of the new points and initialize them at the weighted mean of their neighbours
+    P, sigma = _x2p(X_new, 1e-5, perplexity, method="knn" if method == "barnes_hut" else "exact", progress=progress,
+                    X_fit=X, observer=observer)
+    Y_new = np.asarray(P @ Y)
+    iY = np.zeros_like(Y_new)
+    gains = np.ones_like(Y_new)
+    if method == "barnes_hut":
+        tree = QuadTree(Y)
+        rows = np.repeat(np.arange(n_new), np.diff(P.indptr))
+
+    # Run iterations
+    with Phase(observer, "transform"):
+        for iter in range(max_iter):
+
+            # Compute the gradient of every new point against the fixed points, with Q normalized per new point
+            if method == "exact":
+                num = 1 / (1 + np.sum(np.square(Y_new), 1)[:, np.newaxis] - 2 * np.dot(Y_new, Y.T) + np.sum(np.square(Y), 1))
+                W = (P - num / np.sum(num, 1)[:, np.newaxis]) * num
+                dY = np.sum(W, 1)[:, np.newaxis] * Y_new - np.dot(W, Y)
+            else:
+                num = 1 / (1 + np.sum(np.square(Y_new[rows] - Y[P.indices]), 1))
+                W = sparse.csr_matrix((P.data * num, P.indices, P.indptr), shape=P.shape)
+                neg_f, sum_Q = tree.repulsive_forces(theta, Y_new)
+                dY = np.asarray(W.sum(1)) * Y_new - W @ Y - neg_f / sum_Q[:, np.newaxis]
+
+            # Perform the update
+            if iter < 20:
+                momentum = initial_momentum
+            else:
+                momentum = final_momentum
+            gains = (gains + 0.2) * ((dY > 0) != (iY > 0)) + (gains * 0.8) * ((dY > 0) == (iY > 0))
+            gains[gains < min_gain] = min_gain
+            iY = momentum * iY - learning_rate * (gains * dY)
+            Y_new = Y_new + iY
+
+            if progress is not None:
+                progress("iterations", iter + 1, max_iter)
 
-    return Y, P, Q, sigma
+    return Y_new, P, sigma